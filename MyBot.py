@@ -1,6 +1,9 @@
+import sys
+import numpy as np
 import dexlib.nphlt as hlt
 import logging
 from dexlib.resolver import Resolver
+from dexlib.deadline import Deadline, TurnTimeout
 from dexlib.movement import (
     Combatant,
     MoveMaker,
@@ -13,14 +16,25 @@ from dexlib.movement import (
 
 logging.basicConfig(filename='wtf.info', level=logging.DEBUG, filemode="w")
 
+# How pieces pick noncombat targets, see MoveMaker: `python3 MyBot.py field`
+BOT_NAMES = {'targets': "DexBotNeuer", 'field': "DexBotField"}
+EXPANSION = sys.argv[1] if len(sys.argv) > 1 else 'targets'
+if EXPANSION not in BOT_NAMES:
+    sys.exit('unknown expansion mode %r, expected one of: %s'
+             % (EXPANSION, ', '.join(BOT_NAMES)))
+
+# Seconds a turn may take from reading its frame before whatever has
+# been decided is sent, unresolved moves as straight steps, and
+# everything else stays (the limit is 1s).
+TURN_BUDGET = 0.8
 
 game_map = hlt.ImprovedGameMap(8)
-hlt.send_init("DexBotNeuer")
+hlt.send_init(BOT_NAMES[EXPANSION])
 game_map.get_frame()
 game_map.update()
 
 k = 1.5 - game_map.num_enemies * 0.1
-bord_eval = MoveMaker(game_map, wait=4, glob_k=k)
+bord_eval = MoveMaker(game_map, wait=4, glob_k=k, mode=EXPANSION)
 combatant = Combatant(4)
 resolver = Resolver(game_map)
 amalgamator = Amalgamator(strlim=20)
@@ -28,18 +42,46 @@ nonaggr = Nonaggressor()
 noswapper = Noswapper()
 
 
+deadline = Deadline(TURN_BUDGET)
+
+
 while True:
     logging.debug('TURN ------------' + str(game_map.turn))
-    game_map.update()
-
-    moveset = Moveset(game_map)
-    moveset = combatant.decide_combat_moves(game_map, moveset)
-    moveset = bord_eval.decide_noncombat_moves(game_map, moveset)
-    # moveset = amalgamator.process_moves(game_map, moveset)
-    moveset = resolver.resolve(game_map, moveset)
-    # moveset = amalgamator.process_moved_into(game_map, moveset)
-    moveset = nonaggr.process_moves(game_map, moveset)
-    # moveset = noswapper.process_moves(game_map, moveset)
-
-    hlt.send_frame(moveset.process_moves())
+    deadline.start(game_map.frame_time)
+    moveset = None
+    try:
+        with deadline.stage('update', interruptible=False):
+            game_map.update()
+            moveset = Moveset(game_map)
+
+        with deadline.stage('combat'):
+            moveset = combatant.decide_combat_moves(game_map, moveset)
+        with deadline.stage('noncombat'):
+            moveset = bord_eval.decide_noncombat_moves(game_map, moveset)
+        # moveset = amalgamator.process_moves(game_map, moveset)
+        with deadline.stage('resolve'):
+            moveset = resolver.resolve(game_map, moveset)
+        # moveset = amalgamator.process_moved_into(game_map, moveset)
+        with deadline.stage('nonaggressor'):
+            moveset = nonaggr.process_moves(game_map, moveset)
+        # moveset = noswapper.process_moves(game_map, moveset)
+        deadline.stop()
+
+    except TurnTimeout as timeout:
+        # Pieces decided but not resolved step straight at their
+        # targets, the rest stay
+        deadline.stop()
+        if moveset is None:
+            moveset = Moveset(game_map)
+        stepped = resolver.step_straight(game_map, moveset)
+        moveset = nonaggr.process_moves(game_map, moveset)
+        logging.warning('turn %d over its %.0fms budget in %s (%.0fms): %d pieces moving, '
+                        '%d of them not cap checked, %d staying',
+                        game_map.turn, deadline.budget * 1000, timeout.stage,
+                        deadline.elapsed() * 1000, np.count_nonzero(moveset.dirs),
+                        np.count_nonzero(moveset.dirs[stepped]),
+                        np.count_nonzero(moveset.owned & (moveset.dirs == 0)))
+
+    moveset.set_stays()
+    hlt.send_bytes(moveset.encode())
     game_map.get_frame()
@@ -0,0 +1,106 @@
+"""Border layers that only get recomputed where the map changed."""
+
+
+import numpy as np
+
+
+class BorderTracker:
+    """Keeps ubrdr, obrdr, ebrdr, ubrdr_combat and melee_mat current on
+    an ImprovedGameMap, and owned_locs, ubrdr_locs and ebrdr_locs on
+    itself. Every one of them is a plus-shaped max over owned, enemy or
+    target_cells, so a cell can only flip within two steps of a cell
+    whose inputs changed, which gm.diff says. Those neighbourhoods are
+    recomputed with neighbour gathers; if more than max_change of the
+    map changed, everything is recomputed with full-map filters.
+    """
+
+    def __init__(self, gm, max_change=0.1):
+        self.gm = gm
+        self.max_change = max_change
+        self.nbr_idx = gm.nbr_idx
+        self.turn = None
+        self.owned_locs = self.ubrdr_locs = self.ebrdr_locs = None
+        # Cells whose ubrdr the last update may have changed, flat and
+        # sorted; None when it recomputed everything
+        self.ubrdr_changed = None
+
+    def update(self):
+        """Bring the border layers up to date."""
+        gm = self.gm
+        if self.turn is None or gm.turn != self.turn + 1:
+            # First call, or a frame went by without one: gm.diff only
+            # covers the last frame
+            self._full()
+        else:
+            seeds = self._changed()
+            if len(seeds) > self.max_change * gm.owned.size:
+                self._full()
+            elif len(seeds):
+                self._local(seeds)
+            else:
+                self.ubrdr_changed = np.zeros(0, dtype=int)
+        self.turn = gm.turn
+
+    def _changed(self):
+        """Cells whose owned, enemy or target_cells may have changed
+        since the last frame, from gm.diff: every owner change, and
+        cells whose strn went to or from 0 (blank_zero).
+        """
+        gm, diff = self.gm, self.gm.diff
+        strn_idx = diff.strn_idx
+        now_zero = gm.frames.cur['strn'].ravel()[strn_idx] == 0
+        was_zero = gm.frames.prev['strn'].ravel()[strn_idx] == 0
+        return np.union1d(diff.owner_idx, strn_idx[now_zero != was_zero])
+
+    def _full(self):
+        gm = self.gm
+        gm.plus_filter(gm.owned, max, out=gm.ubrdr)
+        np.subtract(gm.ubrdr, gm.owned, out=gm.ubrdr)
+        gm.plus_filter(gm.ubrdr, max, out=gm.obrdr)
+        np.subtract(gm.obrdr, gm.ubrdr, out=gm.obrdr)
+
+        gm.plus_filter(gm.enemy, max, out=gm.ebrdr)
+        np.subtract(gm.ebrdr, gm.enemy, out=gm.ebrdr)
+
+        np.multiply(gm.ubrdr, gm.target_cells, out=gm.ubrdr_combat)
+        gm.plus_filter(gm.ubrdr_combat, max, out=gm.melee_mat)
+        np.multiply(gm.melee_mat, gm.owned, out=gm.melee_mat)
+
+        self.owned_locs = np.transpose(np.nonzero(gm.owned))
+        self.ubrdr_locs = np.transpose(np.nonzero(gm.ubrdr))
+        self.ebrdr_locs = np.transpose(np.nonzero(gm.ebrdr))
+        self.ubrdr_changed = None
+
+    def _local(self, seeds):
+        gm = self.gm
+        owned, enemy = gm.owned.reshape(-1), gm.enemy.reshape(-1)
+        target = gm.target_cells.reshape(-1)
+        ubrdr, ebrdr = gm.ubrdr.reshape(-1), gm.ebrdr.reshape(-1)
+        ubrdr_combat = gm.ubrdr_combat.reshape(-1)
+
+        # Anything within one step of a change, then within two
+        R1 = self._grow(seeds)
+        R2 = self._grow(R1)
+
+        old_ubrdr, old_ebrdr = ubrdr[R1], ebrdr[R1]
+        ubrdr[R1] = self._plus_max(owned, R1) - owned[R1]
+        ebrdr[R1] = self._plus_max(enemy, R1) - enemy[R1]
+        ubrdr_combat[R1] = ubrdr[R1] * target[R1]
+
+        gm.obrdr.reshape(-1)[R2] = self._plus_max(ubrdr, R2) - ubrdr[R2]
+        gm.melee_mat.reshape(-1)[R2] = self._plus_max(ubrdr_combat, R2) * owned[R2]
+
+        if len(gm.diff.gained(gm.my_id)) or len(gm.diff.lost(gm.my_id)):
+            self.owned_locs = np.transpose(np.nonzero(gm.owned))
+        self.ubrdr_changed = R1[ubrdr[R1] != old_ubrdr]
+        if len(self.ubrdr_changed):
+            self.ubrdr_locs = np.transpose(np.nonzero(gm.ubrdr))
+        if (ebrdr[R1] != old_ebrdr).any():
+            self.ebrdr_locs = np.transpose(np.nonzero(gm.ebrdr))
+
+    def _grow(self, cells):
+        return np.unique(np.concatenate((cells, self.nbr_idx[cells].ravel())))
+
+    def _plus_max(self, X, cells):
+        """plus_filter(X, max) at just cells, all flat."""
+        return np.maximum(X[cells], X[self.nbr_idx[cells]].max(axis=1))
@@ -0,0 +1,125 @@
+"""Which border cells are closest to which targets, kept across turns."""
+
+
+import numpy as np
+
+
+class NearestBorders:
+    """For every target cell, the shortest path length from the border
+    and the border cells tied at that length. Path lengths never change
+    after init, so between turns only the border cells and targets that
+    came or went need looking at, and the caller says which cells those
+    can be. Falls back to solving everything when more than max_change
+    of them did.
+
+    Ties are kept as sorted b * V + u keys (flat indices, V cells), which
+    is also the order calc_bval adds credit in, so the result is the
+    same to the bit as solving from scratch.
+    """
+
+    def __init__(self, sp, chunk=2 ** 20, max_change=0.25):
+        self.sp = sp
+        self.n = sp.w * sp.h
+        self.chunk = chunk
+        self.max_change = max_change
+        self.reset()
+
+    def reset(self):
+        self.Bis = None
+        self.Uis = None
+        self.Umin = None
+        self.keys = None
+
+    def solve(self, Bis, Uis):
+        """Start over from the sorted, unique border cells Bis and
+        targets Uis. Returns the tie keys and the shortest distance to
+        each of Uis.
+        """
+        keys, self.Umin = self._columns(Bis, Uis)
+        self.Bis, self.Uis = Bis, Uis
+        self.keys = np.sort(keys)
+        return self.keys, self.Umin
+
+    def update(self, B_cells, B_now, U_cells, U_now):
+        """Move on from the last call given the unique cells B_cells
+        whose border membership may have changed, and B_now, whether
+        each of them is a border cell now (likewise U_cells and U_now
+        for targets). Every other cell is taken as unchanged. Returns
+        what solve does; self.Bis and self.Uis are the new cells.
+        """
+        B_add, B_rem = self._moved(self.Bis, B_cells, B_now)
+        U_add, U_rem = self._moved(self.Uis, U_cells, U_now)
+        Bis = np.union1d(np.setdiff1d(self.Bis, B_rem, assume_unique=True), B_add)
+        Uis = np.union1d(np.setdiff1d(self.Uis, U_rem, assume_unique=True), U_add)
+
+        changed = len(B_add) + len(B_rem) + len(U_add) + len(U_rem)
+        if changed > self.max_change * (len(Bis) + len(Uis)):
+            return self.solve(Bis, Uis)
+
+        n = self.n
+        keys = self.keys
+        keys = keys[~(np.isin(keys % n, U_rem) | np.isin(keys // n, B_rem))]
+
+        kept = ~np.isin(self.Uis, U_rem, assume_unique=True)
+        U_kept, U_kept_min = self.Uis[kept], self.Umin[kept]
+
+        # Targets that lost every closest border cell start over
+        live = np.isin(U_kept, keys % n)
+        U_live, U_live_min = U_kept[live], U_kept_min[live]
+
+        new_keys = []
+        beaten = np.zeros(len(U_live), dtype=bool)
+        for cols, D in self._blocks(B_add, U_live):
+            D_min = D.min(axis=0)
+            beaten[cols] = D_min < U_live_min[cols]
+            U_live_min[cols] = np.minimum(U_live_min[cols], D_min)
+
+            bi, ui = np.nonzero(D == U_live_min[cols])
+            new_keys.append(B_add[bi] * n + U_live[cols][ui])
+        keys = keys[~np.isin(keys % n, U_live[beaten])]
+
+        U_redo = np.union1d(U_kept[~live], U_add)
+        redo_keys, U_redo_min = self._columns(Bis, U_redo)
+        new_keys.append(redo_keys)
+
+        self.Bis, self.Uis = Bis, Uis
+        self.keys = np.sort(np.concatenate([keys] + new_keys))
+        self.Umin = np.empty(len(Uis), dtype=self.sp.path.dtype)
+        self.Umin[np.searchsorted(Uis, U_live)] = U_live_min
+        self.Umin[np.searchsorted(Uis, U_redo)] = U_redo_min
+
+        return self.keys, self.Umin
+
+    @staticmethod
+    def _moved(cells, maybe, now):
+        """Which of maybe joined and left the sorted cells."""
+        was = np.isin(maybe, cells, assume_unique=True)
+        return np.sort(maybe[now & ~was]), np.sort(maybe[was & ~now])
+
+    def _columns(self, Bis, Uis):
+        """Closest distance and tied border cells of each of Uis from
+        scratch.
+        """
+        keys = [np.zeros(0, dtype=int)]
+        Umin = [np.zeros(0, dtype=self.sp.path.dtype)]
+
+        for cols, D in self._blocks(Bis, Uis):
+            D_min = D.min(axis=0)
+
+            bi, ui = np.nonzero(D == D_min)
+            keys.append(Bis[bi] * self.n + Uis[cols][ui])
+            Umin.append(D_min)
+
+        return np.concatenate(keys), np.concatenate(Umin)
+
+    def _blocks(self, Bis, Uis):
+        """Border x target path lengths, chunk of them at a time: yields
+        a slice of Uis and the len(Bis) x len(slice) block for it, read
+        straight from the solved rows so no bigger block is ever built.
+        """
+        if not len(Bis):
+            return
+        step = max(1, self.chunk // len(Bis))
+        for i in range(0, len(Uis), step):
+            cols = slice(i, i + step)
+            yield cols, self.sp.between(Bis, Uis[cols])
@@ -0,0 +1,101 @@
+"""Keeping every turn inside its time budget."""
+
+
+import time
+import signal
+import functools
+from contextlib import contextmanager
+
+
+class TurnTimeout(Exception):
+    """The turn ran out of time in stage."""
+
+    def __init__(self, stage):
+        super().__init__(stage)
+        self.stage = stage
+
+
+class Deadline:
+    """Time budget for one turn, counted from when its frame was read.
+
+    Each step of the turn runs inside stage(name). When the budget
+    runs out an alarm raises TurnTimeout in the running stage, so the
+    turn can send what it has. Stages entered with interruptible=False
+    (the map update, which must not be left half done) run to the end
+    and raise on the way out instead, and so do functions wrapped in
+    uninterrupted (the Moveset writes). Without setitimer (Windows) the
+    budget is only checked as stages start and end.
+    """
+
+    def __init__(self, budget=0.9):
+        """budget is in seconds."""
+        self.budget = budget
+        self.start_time = time.perf_counter()
+        self.stage_name = None
+        self.interruptible = True
+        self.armed = False
+        self.expired = False
+        self.can_alarm = hasattr(signal, 'setitimer')
+        if self.can_alarm:
+            signal.signal(signal.SIGALRM, self._alarm)
+
+    def start(self, start_time=None):
+        """Start the clock at start_time (default now) and arm the alarm."""
+        self.start_time = time.perf_counter() if start_time is None else start_time
+        self.stage_name = 'frame'
+        self.expired = False
+        self.armed = True
+        if self.can_alarm:
+            signal.setitimer(signal.ITIMER_REAL, max(self.remaining(), 1e-6))
+
+    def stop(self):
+        self.armed = False
+        if self.can_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def remaining(self):
+        return self.budget - self.elapsed()
+
+    @contextmanager
+    def stage(self, name, interruptible=True):
+        self.check()
+        self.stage_name, self.interruptible = name, interruptible
+        try:
+            yield
+        finally:
+            self.interruptible = True
+        self.check()
+
+    def check(self):
+        """Raise TurnTimeout if the budget has run out."""
+        if self.armed and (self.expired or self.remaining() <= 0):
+            self.expired, self.armed = True, False
+            raise TurnTimeout(self.stage_name)
+
+    def _alarm(self, signum, frame):
+        if not self.armed:
+            return
+        self.expired = True
+        if self.interruptible:
+            self.armed = False
+            raise TurnTimeout(self.stage_name)
+
+
+def uninterrupted(f):
+    """Hold the turn's alarm off while f runs, so a TurnTimeout cannot
+    land half way through it; one that came due is raised as f returns.
+    """
+    if not hasattr(signal, 'pthread_sigmask'):
+        return f
+
+    @functools.wraps(f)
+    def wrapper(*args, **kwargs):
+        old = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGALRM})
+        try:
+            return f(*args, **kwargs)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old)
+    return wrapper
@@ -3,48 +3,127 @@
 
 import itertools
 import numpy as np
-from scipy.sparse import dok_matrix
+from scipy.sparse import csr_matrix
 from scipy.sparse.csgraph import dijkstra
 
 
 class ShortestPather:
     """Calculate 4D shortest paths matrix.
     Very expensive, so probably an up-front in init one-and-done deal.
+
+    With lazy=True nothing is solved up front; rows are solved the
+    first time rows() asks for them and kept, in path rows handed out
+    in the order they were solved (slot[v] is the path row of vertex
+    v), so only solved rows take memory. path is float32 either way
+    (edge costs are whole numbers, so nothing is lost), and the
+    predecessor matrix is only built if asked for.
     """
 
-    def __init__(self, strn, prod):
+    # Rows per dijkstra call, to bound the float64 scratch it returns
+    chunk = 256
+
+    def __init__(self, strn, prod, lazy=False, predecessors=False):
         self.w, self.h = strn.shape
         self.vertices = list(itertools.product(range(self.w), range(self.h)))
+        self.lazy = lazy
 
+        n = self.w * self.h
         self.dist = self._get_dist_graph(strn, prod)
-        self.path, self.route = dijkstra(self.dist, False,
-                                         return_predecessors=True)
+        self.path = np.empty((0 if lazy else n, n), dtype=np.float32)
+        self.slot = np.full(n, -1) if lazy else np.arange(n)
+        self.solved = np.zeros(n, dtype=bool)
+        self.route = None
+
+        if predecessors:
+            self.route = dijkstra(self.dist, False, return_predecessors=True)[1]
+        if not lazy:
+            self._solve(np.arange(n))
 
     def _get_dist_graph(self, strn, prod):
         """Get the v*v distance graph.
-        Costs are pulled from thin air.
+        Costs are pulled from thin air, truncated to ints, and
+        zero-cost edges are left out of the graph.
         """
-        dist = dok_matrix((self.w * self.h, self.w * self.h), dtype=int)
+        n = self.w * self.h
+        x, y = np.divmod(np.arange(n), self.h)
+        nbrs = self._get_nbrs(x, y)
+        nx = np.stack([nx for nx, _ in nbrs], axis=1)
+        ny = np.stack([ny for _, ny in nbrs], axis=1)
 
-        for x, y in self.vertices:
-            nbrs = self._get_nbrs(x, y)
-            orig_i = self.get_vertex(x, y)
+        orig = np.repeat(np.arange(n), 4)
+        targ = self.get_vertex(nx, ny).ravel()
+        cost = (strn.ravel()[targ] / (prod.ravel()[orig] + 0.1)).astype(int)
 
-            for nx, ny in nbrs:
-                targ_i = self.get_vertex(nx, ny)
-                dist[orig_i, targ_i] = strn[nx, ny] / (prod[x, y] + 0.1)
+        # A 2-wide map lists the same neighbour twice
+        _, first = np.unique(orig * n + targ, return_index=True)
+        keep = first[cost[first] != 0]
 
-        return dist
+        return csr_matrix((cost[keep], (orig[keep], targ[keep])), shape=(n, n))
 
-    def get_dist_matrix(self):
-        """Get the x*y*x*y matrix of shortest path lengths."""
-        dist_mat = np.zeros((self.w, self.h, self.w, self.h))
-        for x in range(self.w):
-            for y in range(self.h):
-                vertex = self.get_vertex(x, y)
-                dist_mat[x, y, :, :] = self.path[vertex].reshape((self.w, self.h))
+    def _solve(self, sources):
+        if self.lazy:
+            self._reserve(sources)
+        for i in range(0, len(sources), self.chunk):
+            rows = sources[i:(i + self.chunk)]
+            self.path[self.slot[rows]] = dijkstra(self.dist, False, indices=rows)
+        self.solved[sources] = True
+
+    def _reserve(self, sources):
+        """Give sources the next free rows of path, growing it (at least
+        doubling) when it is full.
+        """
+        n_solved = int(self.solved.sum())
+        need = n_solved + len(sources)
+        if need > len(self.path):
+            grown = np.empty((min(len(self.slot), max(need, 2 * len(self.path))),
+                              len(self.slot)), dtype=self.path.dtype)
+            grown[:n_solved] = self.path[:n_solved]
+            self.path = grown
+        self.slot[sources] = np.arange(n_solved, need)
+
+    def _ensure(self, indices):
+        if self.lazy:
+            todo = np.unique(indices[~self.solved[indices]])
+            if len(todo):
+                self._solve(todo)
 
-        return dist_mat
+    def rows(self, indices):
+        """Get the shortest path lengths from each vertex in indices to
+        every vertex, solving any rows not seen before.
+        """
+        self._ensure(indices)
+        return self.path[self.slot[indices]]
+
+    @property
+    def nbytes(self):
+        """Bytes of path actually solved (and so resident)."""
+        return int(self.solved.sum()) * self.path.shape[1] * self.path.itemsize
+
+    def between(self, sources, targets):
+        """Get the sources x targets matrix of shortest path lengths."""
+        self._ensure(sources)
+        return self.path[np.ix_(self.slot[sources], targets)]
+
+    def row(self, vertex):
+        """Get the shortest path lengths from vertex to every vertex as a
+        view into path.
+        """
+        if not self.solved[vertex]:
+            self._solve(np.array([vertex]))
+        return self.path[self.slot[vertex]]
+
+    def get_dist_matrix(self):
+        """Get the x*y*x*y matrix of shortest path lengths. This is a
+        reshaped view of path once its rows are in vertex order (x-major,
+        as get_vertex), so lazy mode solves every row and reorders them
+        first.
+        """
+        if not self.solved.all():
+            self._solve(np.flatnonzero(~self.solved))
+        if (self.slot != np.arange(len(self.slot))).any():
+            self.path = self.path[self.slot]
+            self.slot = np.arange(len(self.slot))
+        return self.path.reshape((self.w, self.h, self.w, self.h))
 
     def _get_nbrs(self, x, y):
         """Return a dictionary of the neighbours and cost of x, y."""
@@ -55,3 +134,71 @@ class ShortestPather:
     def get_vertex(self, x, y):
         """Return the index of vertices containing the pt x, y."""
         return (x * self.h) + y
+
+
+class FlooredPaths:
+    """Shortest path lengths that are never less than the strength of
+    the destination cell, floored as they are read:
+        str_to[x, y, a, b] == max(floor[a, b], path from (x, y) to (a, b))
+    and str_to[x, y] is the (w, h) array of those from (x, y).
+    """
+
+    def __init__(self, sp, floor):
+        self.sp = sp
+        self.floor = floor
+        self.shape = (sp.w, sp.h, sp.w, sp.h)
+
+    def __getitem__(self, key):
+        row = self.sp.row(self.sp.get_vertex(key[0], key[1]))
+        if len(key) == 2:
+            return np.maximum(self.floor, row.reshape(self.floor.shape))
+
+        a, b = key[2], key[3]
+        return max(self.floor[a, b], row[self.sp.get_vertex(a, b)])
+
+
+def potential_field(game_map, values, off):
+    """Distance-like field over owned cells that leads every piece to
+    its best target. Each cell with a positive value is a source,
+    starting at off * best / its value, best being the largest finite
+    value (a target worth half the best counts as off steps further
+    away). Infinite values (smooth_value where the map started at 0
+    strn) start at 0, ahead of every finite one, as targets mode ranks
+    them first too. The field spreads one per step through owned cells
+    only:
+        field[x] == min over targets c of steps(x, c) + start(c)
+    Lower is better; cells the field cannot reach are inf. One
+    multi-source dijkstra, through a virtual vertex feeding the
+    targets, so the cost does not depend on how many pieces there are.
+    """
+    n = game_map.width * game_map.height
+    values = values.ravel()
+    targets = np.flatnonzero(values > 0)
+    field = np.full(game_map.owners.shape, np.inf)
+    if not len(targets):
+        return field
+
+    # Steps into owned cells, from owned cells or targets
+    owned = np.flatnonzero(game_map.owned.ravel())
+    orig = game_map.nbr_idx[owned].ravel()
+    targ = np.repeat(owned, 4)
+    keep = (game_map.owned.ravel()[orig] != 0) | np.isin(orig, targets)
+    orig, targ = orig[keep], targ[keep]
+
+    # A 2-wide map lists the same neighbour twice
+    _, first = np.unique(orig * n + targ, return_index=True)
+    orig, targ = orig[first], targ[first]
+
+    tvalues = values[targets]
+    finite = np.isfinite(tvalues)
+    start = np.zeros(len(targets))
+    if finite.any():
+        start[finite] = off * tvalues[finite].max() / tvalues[finite]
+    graph = csr_matrix(
+        (np.concatenate((start, np.ones(len(orig)))),
+         (np.concatenate((np.full(len(targets), n), orig)),
+          np.concatenate((targets, targ)))),
+        shape=(n + 1, n + 1)
+    )
+    field.ravel()[:] = dijkstra(graph, True, indices=n)[:n]
+    return field
@@ -0,0 +1,47 @@
+"""Manhattan distances on the torus without the 4D table."""
+
+
+import numpy as np
+
+
+class TorusDistances:
+    """Stand-in for the old (w, h, w, h) distance array.
+        dists[x, y, a, b]
+    is the distance between (x, y) and (a, b), floored at 1, and
+        dists[x, y]
+    is a read-only (w, h) view of the distances from (x, y) to every
+    other cell. Only a 2x2 tiling of the distances from the origin is
+    stored; every (x, y) slice is a window into it.
+    """
+
+    def __init__(self, w, h):
+        self.w, self.h = w, h
+        self.shape = (w, h, w, h)
+
+        dx = np.arange(w)
+        dy = np.arange(h)
+        dx = np.minimum(dx, w - dx)
+        dy = np.minimum(dy, h - dy)
+        self.base = np.maximum(dx[:, None] + dy[None, :], 1)
+        self.base.flags.writeable = False
+
+        self.tiled = np.tile(self.base, (2, 2))
+        self.tiled.flags.writeable = False
+
+    def __getitem__(self, key):
+        if len(key) == 2:
+            x, y = key
+            x, y = self.w - (x % self.w), self.h - (y % self.h)
+            return self.tiled[x:(x + self.w), y:(y + self.h)]
+
+        return self.between(*key)
+
+    def between(self, x, y, a, b):
+        """Distances between (x, y) and (a, b), any of which may be
+        arrays; they broadcast like numpy arithmetic.
+        """
+        return self.base[(a - x) % self.w, (b - y) % self.h]
+
+    @property
+    def nbytes(self):
+        return self.base.nbytes + self.tiled.nbytes
@@ -4,113 +4,92 @@ Returns the next step based on some greedy heuristics.
 """
 
 
-def find_pref_next(x, y, nx, ny, gm):
-    """Return two target x,y tuples in order of preference.
-    Blocks have a bunch of heuristics to decide which of
-    the <=2 possible directions is more appropriate.
+import numpy as np
+
+
+def safe_steps(gm):
+    """(w, h, 4) array of whether every cell can 'safely' move into each
+    of its N, E, S, W neighbours (directions 1-4): an owned neighbour
+    unless it is the stronger and the two add up past 255, an unowned
+    one if it is safe to take and weaker (or the mover is at 255).
+    """
+    owned = gm.nbr_stack(gm.owned) != 0
+    nstrn = gm.nbr_stack(gm.strn)
+    strn = gm.strn[..., None]
+
+    crowded = (nstrn > strn) & ((nstrn + strn) > 255)
+    takeable = (gm.nbr_stack(gm.safe_to_take) != 0) & \
+        ((strn >= 255) | (nstrn < strn))
+    return np.where(owned, ~crowded, takeable)
+
+
+def find_pref_nexts(x, y, nx, ny, gm, safe=None):
+    """The two steps from each origin x, y towards its target nx, ny in
+    order of preference, for arrays of pairs. Of the <=2 directions
+    that close the distance:
+      - both owned: the one with lower production first;
+      - one owned: that one, then the other if it can be moved into;
+      - both can be moved into: an enemy first, then the better
+        prodc / strnc;
+      - otherwise whichever can be moved into, else stay.
+    Returns (x1, y1, d1), (x2, y2, d2), each an array per pair; d2 is
+    -1 where there is no second choice. safe is safe_steps(gm) if
+    given.
     """
+    if safe is None:
+        safe = safe_steps(gm)
+    x, y, nx, ny = (np.asarray(v, dtype=int) for v in (x, y, nx, ny))
+    origin = x * gm.height + y
 
-    # Can shortcut a lot of this if I can detect len-1 moves
     dist_north = (y - ny) % gm.height
     dist_east = (nx - x) % gm.width
     dist_south = (ny - y) % gm.height
     dist_west = (x - nx) % gm.width
 
-    if dist_north < dist_south:
-        ypref, ydist = 1, dist_north
-    elif (dist_north == 0):
-        ypref, ydist = None, 0
-    else:
-        ypref, ydist = 3, dist_south
-
-    if dist_east < dist_west:
-        xpref, xdist = 2, dist_east
-    elif (dist_east == 0):
-        xpref, xdist = None, 0
-    else:
-        xpref, xdist = 4, dist_west
-
-    xnx, xny = cardinal_to_nxny(x, y, xpref, gm)
-    ynx, yny = cardinal_to_nxny(x, y, ypref, gm)
-
-    # If both cardinals are owned, prefer to move along the
-    # direction with lower production.
-    if gm.owned[xnx, xny] and gm.owned[ynx, yny] and \
-            ydist > 0 and xdist > 0:
-        if gm.prod[xnx, xny] < gm.prod[ynx, yny]:
-            return (xnx, xny, xpref), (ynx, yny, ypref)
-        else:
-            return (ynx, yny, ypref), (xnx, xny, xpref)
-
-    can_mv_x = can_occupy_safely(x, y, xnx, xny, gm) and xdist > 0
-    can_mv_y = can_occupy_safely(x, y, ynx, yny, gm) and ydist > 0
-
-    # If one direction is owned, move along it
-    if gm.owned[xnx, xny] and xdist > 0 and can_mv_y:
-        return (xnx, xny, xpref), (ynx, yny, ypref)
-    if gm.owned[ynx, yny] and ydist > 0 and can_mv_x:
-        return (ynx, yny, ypref), (xnx, xny, xpref)
-
-    if gm.owned[xnx, xny] and xdist > 0:
-        return (xnx, xny, xpref), (None, None, None)
-    if gm.owned[ynx, yny] and ydist > 0:
-        return (ynx, yny, ypref), (None, None, None)
-
-    # If both directions are possible, take the enemy, and then
-    # the one that will pay for itself sooner.
-    # Really some smarter combat object should be forcing moves here.
-    if can_mv_x and can_mv_y:
-        if gm.enemy[xnx, xny]:
-            return (xnx, xny, xpref), (ynx, yny, ypref)
-        if gm.enemy[ynx, yny]:
-            return (ynx, yny, ypref), (xnx, xny, xpref)
-
-        x_roi = gm.prodc[xnx, xny] / gm.strnc[xnx, xny]
-        y_roi = gm.prodc[ynx, yny] / gm.strnc[ynx, yny]
-
-        if x_roi > y_roi:
-            return (xnx, xny, xpref), (ynx, yny, ypref)
-        else:
-            return (ynx, yny, ypref), (xnx, xny, xpref)
-
-    # Only cases left are when one or no directions are possible
-    if can_mv_x:
-        return (xnx, xny, xpref), (None, None, None)
-    elif can_mv_y:
-        return (ynx, yny, ypref), (None, None, None)
-
-    return (x, y, 0), (None, None, None)
-
-
-def can_occupy_safely(x, y, nx, ny, gm):
-    """Detect if nx, ny can be 'safely' moved into by x, y."""
-    if gm.owned[nx, ny] and \
-            gm.strn[nx, ny] > gm.strn[x, y] and \
-            (gm.strn[nx, ny] + gm.strn[x, y]) > 255:
-        return False
-
-    if gm.owned[nx, ny]:
-        return True
-
-    if not gm.safe_to_take[nx, ny]:
-        return False
-
-    if gm.strn[x, y] >= 255:
-        return True
-
-    if gm.strn[nx, ny] < gm.strn[x, y]:
-        return True
-
-    return False
-
-
-def cardinal_to_nxny(x, y, cardinal, gm):
-    if cardinal == 1:
-        return x, (y - 1) % gm.height
-    elif cardinal == 2:
-        return (x + 1) % gm.width, y
-    elif cardinal == 3:
-        return x, (y + 1) % gm.height
-    elif cardinal == 4:
-        return (x - 1) % gm.width, y
-    return x, y
+    ypref = np.where(dist_north < dist_south, 1,
+                     np.where(dist_north == 0, 0, 3))
+    ydist = np.where(ypref == 1, dist_north, dist_south)
+    xpref = np.where(dist_east < dist_west, 2,
+                     np.where(dist_east == 0, 0, 4))
+    xdist = np.where(xpref == 2, dist_east, dist_west)
+
+    # Cells one step along each preference (the origin for none)
+    step = np.concatenate((origin[:, None], gm.nbr_idx[origin]), axis=1)
+    xcell = step[np.arange(len(x)), xpref]
+    ycell = step[np.arange(len(y)), ypref]
+
+    owned, prod = gm.owned.ravel() != 0, gm.prod.ravel()
+    enemy = gm.enemy.ravel() != 0
+    safe = safe.reshape((-1, 4))
+    xown = owned[xcell] & (xdist > 0)
+    yown = owned[ycell] & (ydist > 0)
+    can_mv_x = safe[origin, xpref - 1] & (xdist > 0)
+    can_mv_y = safe[origin, ypref - 1] & (ydist > 0)
+
+    roi = gm.prodc.ravel() / gm.strnc.ravel()
+    x_better = np.select(
+        [xown & yown, can_mv_x & can_mv_y & enemy[xcell],
+         can_mv_x & can_mv_y & enemy[ycell]],
+        [prod[xcell] < prod[ycell], True, False],
+        roi[xcell] > roi[ycell]
+    )
+
+    # 0 stays put, 1 moves along x first, 2 along y first
+    first = np.select(
+        [xown & yown, xown & can_mv_y, yown & can_mv_x, xown, yown,
+         can_mv_x & can_mv_y, can_mv_x, can_mv_y],
+        [np.where(x_better, 1, 2), 1, 2, 1, 2,
+         np.where(x_better, 1, 2), 1, 2],
+        0
+    )
+    has_second = (xown & yown) | (xown & can_mv_y) | (yown & can_mv_x) | \
+        (~xown & ~yown & can_mv_x & can_mv_y)
+
+    cell1 = np.select([first == 1, first == 2], [xcell, ycell], origin)
+    d1 = np.select([first == 1, first == 2], [xpref, ypref], 0)
+    cell2 = np.where(first == 1, ycell, xcell)
+    d2 = np.where(has_second, np.where(first == 1, ypref, xpref), -1)
+
+    x1, y1 = np.divmod(cell1, gm.height)
+    x2, y2 = np.divmod(cell2, gm.height)
+    return (x1, y1, d1), (x2, y2, d2)
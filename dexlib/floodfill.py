@@ -2,49 +2,73 @@
 
 
 import numpy as np
-from collections import deque
 
 
-def dist_to(game_map, sources):
+def dist_to(game_map, sources, out=None, max_dist=None):
     """Get the distance to any of coordinates in sources."""
-    dist = np.empty_like(game_map.owners)
-    dist.fill(-1)
+    return _bfs(game_map, sources, None, out, max_dist)
 
-    for sx, sy in sources:
-        dist[sx, sy] = 0
 
-    ds = deque(sources)
-    while len(ds) > 0:
-        cx, cy = ds.popleft()
-        c_dist = dist[cx, cy]
-        for nx, ny in game_map.nbrs[cx, cy]:
-            if dist[nx, ny] == -1 or dist[nx, ny] > (c_dist + 1):
-                dist[nx, ny] = c_dist + 1
-                ds.append((nx, ny))
+def friendly_to(game_map, sources, out=None, max_dist=None):
+    """Get the distance to any of coordinates in sources if only
+    movement along friendly cells is allowed.
+    """
+    return _bfs(game_map, sources, game_map.owned.ravel(), out, max_dist)
 
-    return dist
 
+def _bfs(game_map, sources, passable, out, max_dist):
+    """Multi-source breadth first search, one whole frontier at a time.
+    Cells are only entered if passable (flat, by x*h + y) is nonzero.
+    Unreached cells are -1, which includes everything further than
+    max_dist from the sources when a limit is given.
+    """
+    if out is None:
+        out = np.empty(game_map.owners.shape, dtype=int)
+    out.fill(-1)
+    dist = out.reshape(-1)
 
-def friendly_to(game_map, sources):
-    """Get the distance to any of coordinates in sources if only
-    movement along friendly cells is allowed.
+    sources = np.asarray(sources, dtype=int).reshape((-1, 2))
+    frontier = np.unique(sources[:, 0] * game_map.height + sources[:, 1])
+    dist[frontier] = 0
+
+    d = 0
+    while len(frontier) and (max_dist is None or d < max_dist):
+        d += 1
+        cands = game_map.nbr_idx[frontier].ravel()
+        cands = cands[dist[cands] == -1]
+        if passable is not None:
+            cands = cands[passable[cands] != 0]
+        frontier = np.unique(cands)
+        dist[frontier] = d
+
+    return out
+
+
+def nearest_to(game_map, sources, out=None):
+    """Label every cell with the flat (x*h + y) index of the closest of
+    sources on the open torus, ties going to the lowest index, which
+    is the cell np.argmax(src / dists[x, y]) picks for a 0/1 mask src.
+    A multi-source BFS carrying labels, so it costs one pass over the
+    map however many cells look things up. Cells are -1 if there are
+    no sources.
     """
-    dist = np.empty_like(game_map.owners)
-    dist.fill(-1)
+    if out is None:
+        out = np.empty(game_map.owners.shape, dtype=int)
+    out.fill(-1)
+    label = out.reshape(-1)
 
-    for sx, sy in sources:
-        dist[sx, sy] = 0
+    sources = np.asarray(sources, dtype=int).reshape((-1, 2))
+    frontier = np.unique(sources[:, 0] * game_map.height + sources[:, 1])
+    label[frontier] = frontier
 
-    ds = deque(sources)
-    while len(ds) > 0:
-        cx, cy = ds.popleft()
-        c_dist = dist[cx, cy]
-        for nx, ny in game_map.nbrs[cx, cy]:
-            if not game_map.owned[nx, ny]:
-                continue
+    while len(frontier):
+        cands = game_map.nbr_idx[frontier].ravel()
+        labels = np.repeat(label[frontier], 4)
+        fresh = label[cands] == -1
+        cands, labels = cands[fresh], labels[fresh]
 
-            if dist[nx, ny] == -1 or dist[nx, ny] > (c_dist + 1):
-                dist[nx, ny] = c_dist + 1
-                ds.append((nx, ny))
+        frontier = np.unique(cands)
+        label[frontier] = np.iinfo(label.dtype).max
+        np.minimum.at(label, cands, labels)
 
-    return dist
+    return out
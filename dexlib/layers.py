@@ -0,0 +1,176 @@
+"""Preallocated map layers, so a turn can be derived without allocating."""
+
+
+import time
+import numpy as np
+
+
+class LayerStore:
+    """C-contiguous x*y arrays keyed by name. A layer is allocated the
+    first time it is asked for and the same buffer is handed back on
+    every later call, to be overwritten in place.
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+        self.layers = {}
+
+    def __call__(self, name, dtype=int):
+        try:
+            return self.layers[name]
+        except KeyError:
+            layer = np.zeros(self.shape, dtype=dtype)
+            self.layers[name] = layer
+            return layer
+
+    def __getitem__(self, name):
+        return self.layers[name]
+
+    def nbytes(self):
+        return sum(layer.nbytes for layer in self.layers.values())
+
+
+class DoubleBuffer:
+    """The current and previous frame of a set of layers. swap() makes
+    the current frame the previous one and hands the old previous
+    buffers back as the current frame to be overwritten.
+    """
+
+    def __init__(self, shape, names, dtype=int):
+        self.cur = LayerStore(shape)
+        self.prev = LayerStore(shape)
+        for name in names:
+            self.cur(name, dtype)
+            self.prev(name, dtype)
+
+    def swap(self):
+        self.cur, self.prev = self.prev, self.cur
+
+
+class FrameDiff:
+    """What changed between the previous and current frame of a
+    DoubleBuffer of owners and strn, as decoded. Cells are flat x*h + y
+    indices.
+    """
+
+    def __init__(self, shape):
+        self.owner_changed = np.zeros(shape, dtype=bool)
+        self.strn_changed = np.zeros(shape, dtype=bool)
+        self.owner_idx = self.strn_idx = np.zeros(0, dtype=int)
+        self.new_owner = self.old_owner = np.zeros(0, dtype=int)
+
+    def update(self, frames):
+        cur, prev = frames.cur, frames.prev
+        np.not_equal(cur['owners'], prev['owners'], out=self.owner_changed)
+        np.not_equal(cur['strn'], prev['strn'], out=self.strn_changed)
+        self.owner_idx = np.flatnonzero(self.owner_changed)
+        self.strn_idx = np.flatnonzero(self.strn_changed)
+        self.new_owner = cur['owners'].ravel()[self.owner_idx]
+        self.old_owner = prev['owners'].ravel()[self.owner_idx]
+
+    def gained(self, player):
+        """Cells player owns now but did not last frame."""
+        return self.owner_idx[self.new_owner == player]
+
+    def lost(self, player):
+        """Cells player owned last frame but does not now."""
+        return self.owner_idx[self.old_owner == player]
+
+
+def layer(*outputs, inputs=(), static=False):
+    """Mark a map method as the node computing the named layers from
+    inputs (other layers, or sources the map touches when they change).
+    static nodes are computed once, up front.
+    """
+    def wrap(f):
+        f.layer = (outputs, inputs, static)
+        return f
+    return wrap
+
+
+class LayerGraph:
+    """Lazily computed layers on a map object. Every @layer method of
+    the map is a node; its outputs are left off the map until first
+    read, then computed (inputs first, as the method reads them) and
+    kept. new_frame() drops every node downstream of a touched source,
+    so a node is only recomputed when one of its inputs changed.
+
+    Outputs named in the map's LayerStore are bound to their buffer
+    before the method runs, so methods write in place with out=.
+    Nodes read the map as it is when they are first asked for, so a
+    node first read late in a turn sees in-turn edits (e.g. to strn).
+    """
+
+    def __init__(self, owner, dtypes):
+        self.owner = owner
+        self.dtypes = dtypes
+        self.nodes = {}
+        self.outputs = {}
+        self.touched = set()
+        self.fresh = set()
+        self.times = {}
+
+        for name in dir(type(owner)):
+            spec = getattr(getattr(type(owner), name), 'layer', None)
+            if spec is not None:
+                self.nodes[name] = spec
+                for out in spec[0]:
+                    self.outputs[out] = name
+
+        self.order = []
+        for name in sorted(self.nodes):
+            self._visit(name, set())
+
+        for name in self.order:
+            if self.nodes[name][2]:
+                self.compute(name)
+
+    def _visit(self, name, path):
+        if name in self.order:
+            return
+        path.add(name)
+        for inp in self.nodes[name][1]:
+            if inp in self.outputs and self.outputs[inp] not in path:
+                self._visit(self.outputs[inp], path)
+        self.order.append(name)
+
+    def touch(self, source):
+        self.touched.add(source)
+
+    def new_frame(self):
+        """Forget every node that depends on a touched source."""
+        stale = set(self.touched)
+        for name in self.order:
+            outputs, inputs, _ = self.nodes[name]
+            if any(inp in stale or self.outputs.get(inp) in stale for inp in inputs):
+                stale.add(name)
+                self.fresh.discard(name)
+                for out in outputs:
+                    self.owner.__dict__.pop(out, None)
+        self.touched.clear()
+
+    def ensure(self, output):
+        if self.outputs[output] not in self.fresh:
+            self.compute(self.outputs[output])
+
+    def compute(self, name):
+        outputs, _, _ = self.nodes[name]
+        for out in outputs:
+            if out in self.dtypes:
+                self.owner.__dict__[out] = self.owner.layers(out, self.dtypes[out])
+
+        start = time.perf_counter()
+        try:
+            getattr(self.owner, name)()
+        except BaseException:
+            # Interrupted (e.g. by a TurnTimeout): drop the half-written
+            # outputs so they are rebuilt when next read.
+            for out in outputs:
+                self.owner.__dict__.pop(out, None)
+            raise
+        self.times[name] = time.perf_counter() - start
+        self.fresh.add(name)
+
+    def report(self):
+        """Compute time of each node the last time it ran, slowest first."""
+        return sorted(self.times.items(), key=lambda kv: -kv[1])
@@ -1,50 +1,99 @@
 """Everything to do with macro movement. Combat, expansion, addons."""
 
 
-import random
 import numpy as np
 import dexlib.nphlt as hlt
-from scipy.ndimage.filters import gaussian_filter
 from dexlib.floodfill import friendly_to
+from dexlib.targeting import TargetScores
+from dexlib.dijkstra import potential_field
+from dexlib.deadline import uninterrupted
 
 import logging
 logging.basicConfig(filename='wtf.info', level=logging.DEBUG, filemode="w")
 
 
 class Moveset:
-    """A mutable move manager!"""
+    """A mutable move manager! Moves are kept in grids over the map:
+    the direction each piece sends, the flat index of the cell it is
+    headed for and whether it has been decided yet, plus the order the
+    pieces were first decided in (which the resolver goes by).
+    set_moves writes any number of moves at once; add_move and the
+    iterators are the same thing for one piece at a time. Neither can
+    be cut short by a TurnTimeout.
+    """
 
     def __init__(self, gm):
-        self.to_move = set(((x, y) for (x, y) in gm.owned_locs))
-        self.move_dict = {}
-        self.move_matrix = np.zeros_like(gm.owned, dtype=bool)
-        self.moved_into = np.zeros_like(gm.owned, dtype=bool)
-
+        self.height = gm.height
+        self.owned = gm.owned != 0
+        self.dirs = np.zeros(gm.owned.shape, dtype=np.int8)
+        self.target = np.arange(gm.width * gm.height).reshape(gm.owned.shape)
+        self.decided = np.zeros(gm.owned.shape, dtype=bool)
+        self.rank = np.zeros(gm.owned.shape, dtype=int)
+        self.n_decided = 0
+
+    @uninterrupted
+    def set_moves(self, ax, ay, tx, ty, dirs=0):
+        """Register a move from every ax, ay to tx, ty (arrays)."""
+        new = ~self.decided[ax, ay]
+        self.rank[ax[new], ay[new]] = self.n_decided + np.arange(new.sum())
+        self.n_decided += new.sum()
+        self.decided[ax, ay] = True
+        self.target[ax, ay] = tx * self.height + ty
+        self.dirs[ax, ay] = dirs
+
+    @uninterrupted
     def add_move(self, ax, ay, tx, ty, dir_=None):
         """Register a move."""
-        self.move_dict[(ax, ay)] = tx, ty, dir_
-        self.move_matrix[ax, ay] = True
-        if (ax, ay) in self.to_move:
-            self.to_move.remove((ax, ay))
+        if not self.decided[ax, ay]:
+            self.decided[ax, ay] = True
+            self.rank[ax, ay] = self.n_decided
+            self.n_decided += 1
+        self.target[ax, ay] = tx * self.height + ty
+        self.dirs[ax, ay] = dir_ or 0
+
+    def get_move(self, ax, ay):
+        """tx, ty, dir_ of the piece at ax, ay, None if undecided."""
+        if not self.decided[ax, ay]:
+            return None
+        return (*divmod(int(self.target[ax, ay]), self.height),
+                int(self.dirs[ax, ay]))
+
+    def decided_locs(self):
+        """(n, 2) array of the decided pieces in the order decided."""
+        cells = np.flatnonzero(self.decided)
+        cells = cells[np.argsort(self.rank.ravel()[cells])]
+        return np.transpose(np.divmod(cells, self.height))
 
     def iter_remaining(self):
         """Iterate over all remaining moves."""
-        for ax, ay in self.to_move:
+        for ax, ay in np.transpose(np.nonzero(self.owned & ~self.decided)).tolist():
             yield ax, ay
 
     def iter_all(self):
-        """Iterate over all remaining moves."""
-        for ax, ay in self.move_dict.keys():
+        """Iterate over all decided moves."""
+        for ax, ay in self.decided_locs().tolist():
             yield ax, ay
 
+    def iter_moves(self):
+        """Iterate over (ax, ay), (tx, ty, dir_) of all decided moves,
+        reading each as it comes up.
+        """
+        for ax, ay in self.iter_all():
+            yield (ax, ay), self.get_move(ax, ay)
+
     def process_moves(self):
         """Convert everything to what the hlt.py expects."""
-        return [hlt.Move(ax, ay, dir_)
-                for (ax, ay), (_, _, dir_) in self.move_dict.items()]
+        return [hlt.Move(ax, ay, dir_) for (ax, ay), (_, _, dir_) in self.iter_moves()]
+
+    def encode(self):
+        """The whole frame of moves as one line of bytes."""
+        cells = np.flatnonzero(self.decided)
+        x, y = np.divmod(cells, self.height)
+        return hlt.encode_ints(np.stack((x, y, self.dirs.ravel()[cells]), axis=1))
 
     def set_stays(self):
-        for x, y in self.to_move:
-            self.move_dict[(x, y)] = x, y, 0
+        x, y = np.nonzero(self.owned & ~self.decided)
+        self.set_moves(x, y, x, y)
 
 
 class Combatant:
@@ -59,27 +108,57 @@ class Combatant:
         return moveset
 
     def decide_melee_moves(self, gm, moveset):
+        """Send every ready melee piece, strongest first, to its best
+        neighbour by combat_heur, dividing the chosen cell's combat_heur
+        down so others pile on less. All the neighbour scores are taken
+        up front. Dividing a cell can only change the pick of a piece
+        that wanted that cell, so only the pieces still to go whose
+        pick it was are rescored.
+        """
         locs = np.transpose(np.nonzero(gm.melee_mat))
-        strns = [gm.strn[x, y] for (x, y) in locs]
-
-        for ci in np.argsort(strns)[::-1]:
-            cx, cy = locs[ci]
-            if gm.strnc[cx, cy] < (gm.prodc[cx, cy] * self.combat_wait):
-                continue
-
-            nbrs = gm.nbrs[(cx, cy)]
-            scores = [gm.combat_heur[nx, ny] - (gm.wall[nx, ny] * 100000)
-                      for (nx, ny) in nbrs]
-
-            nx, ny = nbrs[np.argmax(scores)]
-
-            if gm.total_strn < gm.strn[nx, ny] or not gm.safe_to_take[nx, ny]:
-                nx, ny = cx, cy
-
-            gm.combat_heur[nx, ny] /= 10000
+        strns = gm.strn[locs[:, 0], locs[:, 1]]
+        order = np.argsort(strns)[::-1]
+
+        ready = gm.strnc[locs[:, 0], locs[:, 1]] >= \
+            gm.prodc[locs[:, 0], locs[:, 1]] * self.combat_wait
+        order = order[ready[order]]
+
+        flat = locs[:, 0] * gm.height + locs[:, 1]
+        nbrs = gm.nbr_idx[flat]
+        walls = gm.wall.reshape(-1)[nbrs] * 100000
+        scores = gm.combat_heur.reshape(-1)[nbrs] - walls
+        picks = nbrs[np.arange(len(nbrs)), scores.argmax(axis=1)]
+        unsafe = (gm.total_strn < gm.strn) | (gm.safe_to_take == 0)
+
+        # Plain lists from here on; the loop is all scalar lookups
+        heur = {}
+        picks = picks.tolist()
+        nbrs, walls = nbrs.tolist(), walls.tolist()
+        unsafe, flat = unsafe.reshape(-1).tolist(), flat.tolist()
+        combat_heur = gm.combat_heur.reshape(-1)
+        picked_by = {}
+        done = [False] * len(picks)
+        for ci in order.tolist():
+            picked_by.setdefault(picks[ci], []).append(ci)
+
+        for ci in order.tolist():
+            done[ci] = True
+            target = flat[ci] if unsafe[picks[ci]] else picks[ci]
+            heur[target] = int(heur.get(target, combat_heur[target]) / 10000)
+
+            for cj in picked_by.pop(target, ()):
+                if done[cj] or picks[cj] != target:
+                    continue
+                cell_scores = [heur.get(n, combat_heur[n]) - wall
+                               for n, wall in zip(nbrs[cj], walls[cj])]
+                picks[cj] = nbrs[cj][cell_scores.index(max(cell_scores))]
+                picked_by.setdefault(picks[cj], []).append(cj)
 
             # logging.debug(('combat', (cx, cy), 'to', (nx, ny)))
-            moveset.add_move(cx, cy, nx, ny)
+            moveset.add_move(*locs[ci], *divmod(target, gm.height))
+
+        for cell, value in heur.items():
+            combat_heur[cell] = value
 
     def decide_close_moves(self, gm, moveset):
         locs = np.transpose(np.nonzero(gm.close_to_combat))
@@ -94,8 +173,7 @@ class Combatant:
             if gm.dist_from_combat[cx, cy] > 6:
                 continue
 
-            dmat = np.divide(gm.melee_mat, gm.dists[cx, cy])
-            tx, ty = np.unravel_index(dmat.argmax(), dmat.shape)
+            tx, ty = divmod(gm.nearest_melee[cx, cy], gm.height)
 
             if gm.total_strn < gm.strn[tx, ty] or not gm.safe_to_take[tx, ty]:
                 tx, ty = cx, cy
@@ -113,18 +191,27 @@ class MoveMaker:
     """Evaluate the value of border squares and coordinate moves.
     Values are taken for each x, y, s, where s is the degree to which
     to hunt for teamups.
+
+    mode is how pieces pick where to go: 'targets' scores every border
+    cell for every piece, 'field' has every piece step down one
+    potential field built from the values (see potential_field).
+    seed seeds the random steps of the wall-up and final turn moves.
     """
-    def __init__(self, gm, wait, glob_k):
+    MODES = ('targets', 'field')
+
+    def __init__(self, gm, wait, glob_k, mode='targets', seed=0):
+        if mode not in self.MODES:
+            raise ValueError('unknown mode %r, expected one of %s' % (mode, self.MODES))
         self.glob_k = glob_k
         self.bulk_mvmt_off = 10
         self.wait = wait
+        self.mode = mode
+        self.rng = np.random.default_rng(seed)
 
     def decide_noncombat_moves(self, gm, moveset):
-        working_strn = gm.strn.copy()
-
         motile = ((gm.strnc >= gm.prodc * self.wait) * gm.owned).astype(bool)
         motile[np.nonzero(gm.gte_nbr)] = True
-        motile[np.nonzero(moveset.move_matrix)] = False
+        motile[moveset.decided] = False
 
         Vloc, Vmid, Vglob = self.get_cell_value(gm)
         Vloc *= gm.safe_to_take
@@ -136,11 +223,15 @@ class MoveMaker:
             # Vglob = gm.havens
             return self.process_wallup(gm, moveset)
 
+        if self.mode == 'field':
+            return self.follow_field(gm, moveset, motile, Vmid + Vglob)
+
         self.desired_d1_moves = {}
-        d1_conquered = np.ones_like(Vtot, dtype=bool)
 
         to_move_locs = np.transpose(np.nonzero(motile))
         to_move_strn = [gm.strn[x, y] for (x, y) in to_move_locs]
+        scores = TargetScores(gm.dists, to_move_locs, gm.strn, gm.prodc,
+                              Vmid, Vglob, self.bulk_mvmt_off)
         for ai in np.argsort(to_move_strn)[::-1]:
             ax, ay = to_move_locs[ai]
 
@@ -150,12 +241,7 @@ class MoveMaker:
             #         gm.strn[ax, ay] < (gm.prod[ax, ay] * 6):
             #     moveset.add_move(ax, ay, ax, ay)
             #     continue
-            t2c = np.maximum(0, (working_strn - gm.strn[ax, ay]) / gm.prodc)
-
-            prox_value = np.divide(Vmid, (gm.dists[ax, ay] + t2c)) * d1_conquered + \
-                np.divide(Vglob, (gm.dists[ax, ay] + self.bulk_mvmt_off))
-            prox_value[ax, ay] *= 2
-            tx, ty = np.unravel_index(prox_value.argmax(), prox_value.shape)
+            tx, ty = scores.target(ai)
 
             if gm.total_strn < gm.strn[tx, ty] or not gm.safe_to_take[tx, ty]:
                 tx, ty = ax, ay
@@ -167,7 +253,35 @@ class MoveMaker:
                 self.desired_d1_moves.setdefault((tx, ty), []).append((ax, ay))
                 if gm.strn[ax, ay] > gm.strn[tx, ty]:
                     # No one else can erroneously target this cell
-                    d1_conquered[tx, ty] = 0
+                    scores.conquer(tx, ty)
+
+        self.process_d1_teamups(gm)
+        return moveset
+
+    def follow_field(self, gm, moveset, motile, V):
+        """Move every motile piece to its neighbour lowest on the field,
+        if that is lower than where it is. Pieces the field does not
+        reach stay put.
+        """
+        self.desired_d1_moves = {}
+
+        field = potential_field(gm, V, self.bulk_mvmt_off)
+        nbr_field = gm.nbr_stack(field)
+
+        to_move_locs = np.transpose(np.nonzero(motile))
+        ax, ay = to_move_locs[:, 0], to_move_locs[:, 1]
+        step = nbr_field[ax, ay].argmin(axis=1)
+        lower = nbr_field[ax, ay, step] < field[ax, ay]
+        tx, ty = np.divmod(gm.nbr_idx[ax * gm.height + ay, step], gm.height)
+        tx, ty = np.where(lower, tx, ax), np.where(lower, ty, ay)
+
+        for ax, ay, tx, ty in zip(ax, ay, tx, ty):
+            if gm.total_strn < gm.strn[tx, ty] or not gm.safe_to_take[tx, ty]:
+                tx, ty = ax, ay
+
+            moveset.add_move(ax, ay, tx, ty)
+            if not (ax == tx and ay == ty):
+                self.desired_d1_moves.setdefault((tx, ty), []).append((ax, ay))
 
         self.process_d1_teamups(gm)
         return moveset
@@ -175,9 +289,7 @@ class MoveMaker:
     def get_cell_value(self, gm):
         # local_value = gm.prodc * gm.ubrdr
         # Should set this to ignore my strn and prod
-        mid_value = gaussian_filter(
-            (gm.prodc ** 2 / gm.original_strn), 1.2, mode='wrap'
-        ) * gm.ubrdr
+        mid_value = gm.smooth_value * gm.ubrdr
         local_value = np.maximum(mid_value, (gm.prodc ** 2 / gm.strnc)) * gm.ubrdr
         global_value = gm.Mbval
 
@@ -222,32 +334,34 @@ class MoveMaker:
         if gm.turn == gm.last_turn:
             return self.process_final_turn(gm, moveset)
         d2w = friendly_to(gm, np.transpose(np.nonzero(gm.obrdr)))
-        for x, y in gm.owned_locs:
-            if gm.strnc[x, y] < gm.prodc[x, y] * self.wait:
-                continue
+        movers = (gm.owned != 0) & (gm.strnc >= gm.prodc * self.wait)
+        downhill = (gm.nbr_stack(d2w) < d2w[..., None]) & \
+            (gm.nbr_stack(gm.strn) < gm.strn[..., None])
 
-            nbrs = [(nx, ny) for (nx, ny) in gm.nbrs[x, y] if
-                    d2w[nx, ny] < d2w[x, y] and
-                    gm.strn[nx, ny] < gm.strn[x, y]]
-            if not len(nbrs):
-                moveset.add_move(x, y, x, y)
-            else:
-                nx, ny = random.choice(nbrs)
-                moveset.add_move(x, y, nx, ny)
+        x, y = np.nonzero(movers)
+        moveset.set_moves(x, y, *self.random_steps(gm, x, y, downhill[x, y]))
         return moveset
 
     def process_final_turn(self, gm, moveset):
         """Go crazy."""
         gm.safe_to_take.fill(True)
-        for x, y in np.transpose(np.nonzero(gm.obrdr)):
-            nbrs = [(nx, ny) for (nx, ny) in gm.nbrs[x, y] if gm.owned[nx, ny] == 0 and
-                    gm.strn[x, y] > gm.strn[nx, ny]]
-            if not len(nbrs):
-                continue
-            nx, ny = random.choice(nbrs)
-            moveset.add_move(x, y, nx, ny)
+        valid = (gm.nbr_stack(gm.owned) == 0) & \
+            (gm.nbr_stack(gm.strn) < gm.strn[..., None])
+        x, y = np.nonzero((gm.obrdr != 0) & valid.any(axis=2))
+        moveset.set_moves(x, y, *self.random_steps(gm, x, y, valid[x, y]))
         return moveset
 
+    def random_steps(self, gm, x, y, valid):
+        """A uniformly random neighbour of each x, y among the N, E, S,
+        W ones marked in valid (n, 4), and x, y itself if none are.
+        """
+        count = valid.sum(axis=1)
+        pick = (self.rng.random(len(count)) * count).astype(int)
+        step = (valid & (valid.cumsum(axis=1) == pick[:, None] + 1)).argmax(axis=1)
+        cells = np.where(count > 0, gm.nbr_idx[x * gm.height + y, step],
+                         x * gm.height + y)
+        return np.divmod(cells, gm.height)
+
 
 class Amalgamator:
     """Union pieces together if it makes sense to do so."""
@@ -258,22 +372,32 @@ class Amalgamator:
         self.mvlim = mvlim
 
     def process_moves(self, gm, moveset):
-        for (ax, ay), (tx, ty, _) in moveset.move_dict.items():
-            if ax == tx and ay == tx:
-                continue
-            if gm.strn[ax, ay] >= self.strlim:
-                continue
-            d2t = gm.dists[ax, ay, tx, ty]
-            for nx, ny in gm.oneaways[ax, ay]:
-                if gm.owned[nx, ny] and gm.strn[nx, ny] < self.strlim:
-                    try:
-                        ntx, nty, _ = moveset.move_dict[nx, ny]
-                    except:
-                        continue
-                    dist_targs = gm.dists[ntx, nty, tx, ty]
-                    if dist_targs * self.mvlim < d2t:
-                        moveset.add_move(ax, ay, nx, ny)
-                        moveset.add_move(nx, ny, ax, ay)
+        """Weak moving pieces two cells apart whose targets are much
+        closer to each other than the piece is to its own head for
+        each other instead. A piece with several such partners takes
+        the last in N, E, S, W order, and a partner that picked nobody
+        itself heads for one of the pieces that picked it.
+        """
+        target = moveset.target.ravel()
+        weak = moveset.decided & (gm.owned != 0) & (gm.strn < self.strlim)
+        a = np.flatnonzero(weak)
+        a = a[target[a] != a]
+
+        ax, ay = np.divmod(a, gm.height)
+        tx, ty = np.divmod(target[a], gm.height)
+        nbrs = gm.oneaway_idx[a]
+        ntx, nty = np.divmod(target[nbrs], gm.height)
+        pairs = weak.ravel()[nbrs] & \
+            (gm.dists[ntx, nty, tx[:, None], ty[:, None]] * self.mvlim <
+             gm.dists[ax, ay, tx, ty][:, None])
+
+        paired = pairs.any(axis=1)
+        partner = nbrs[paired, 3 - pairs[paired, ::-1].argmax(axis=1)]
+        a = a[paired]
+        px, py = np.divmod(partner, gm.height)
+        ax, ay = np.divmod(a, gm.height)
+        moveset.set_moves(px, py, ax, ay)
+        moveset.set_moves(ax, ay, px, py)
 
         return moveset
 
@@ -298,13 +422,13 @@ class Nonaggressor:
         pass
 
     def process_moves(self, gm, moveset):
-        stays = []
-        for (ax, ay), (tx, ty, _) in moveset.move_dict.items():
-            if not gm.safe_to_take[tx, ty]:
-                stays.append((ax, ay))
-
-        for ax, ay in stays:
-            moveset.add_move(ax, ay, ax, ay, 0)
+        """Keep every piece headed for a cell that is not safe to take
+        where it is.
+        """
+        stays = moveset.decided & \
+            ~gm.safe_to_take.ravel()[moveset.target].astype(bool)
+        ax, ay = np.nonzero(stays)
+        moveset.set_moves(ax, ay, ax, ay)
 
         return moveset
 
@@ -315,21 +439,15 @@ class Noswapper:
         self.swaplim = swaplim
 
     def process_moves(self, gm, moveset):
-        stays = []
-        for (ax, ay), (tx, ty, dir_) in moveset.move_dict.items():
-            # logging.info(f'see {ax}, {ay}: {tx}, {ty}, {dir_}')
-            if ax == tx and ay == ty:
-                continue
-            if (tx, ty) in moveset.move_dict.keys():
-                ttx, tty, _ = moveset.move_dict[tx, ty]
-                if ttx == ax and tty == ay:  # and \
-                        # gm.strn[ax, ay] > self.swaplim and \
-                        # gm.strn[ttx, tty] > self.swaplim:
-                    stays.append((ax, ay))
-                    stays.append((tx, ty))
-
-        for ax, ay in stays:
-            # logging.info(f'staying {ax}, {ay}')
-            moveset.add_move(ax, ay, ax, ay, 0)
+        """Keep both pieces of every swap, where each is headed for
+        the other's cell, where they are.
+        """
+        target = moveset.target.ravel()
+        cells = np.arange(len(target))
+        moving = moveset.decided.ravel() & (target != cells)
+        # Could only count swaps with gm.strn > self.swaplim on both sides
+        swaps = moving & moveset.decided.ravel()[target] & (target[target] == cells)
+        ax, ay = np.divmod(np.flatnonzero(swaps), gm.height)
+        moveset.set_moves(ax, ay, ax, ay)
 
         return moveset
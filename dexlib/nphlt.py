@@ -1,11 +1,18 @@
 """Everything that changes per turn in a do-it-all map class."""
 
 import sys
+import time
+import logging
 import numpy as np
 from collections import namedtuple
-from scipy.ndimage.filters import generic_filter, maximum_filter
-from dexlib.dijkstra import ShortestPather
-from dexlib.floodfill import friendly_to
+from scipy.ndimage import gaussian_filter
+from dexlib.dijkstra import ShortestPather, FlooredPaths
+from dexlib.stencil import torus_filter, PLUS, SQUARE
+from dexlib.floodfill import friendly_to, nearest_to
+from dexlib.layers import LayerStore, LayerGraph, DoubleBuffer, FrameDiff, layer
+from dexlib.distances import TorusDistances
+from dexlib.bordervalue import NearestBorders
+from dexlib.borders import BorderTracker
 
 
 # import logging
@@ -13,6 +20,9 @@ from dexlib.floodfill import friendly_to
 
 Move = namedtuple('Move', 'x y dir')
 
+# Per-player totals, each an array indexed by player id (0 is blank)
+PlayerStats = namedtuple('PlayerStats', 'strn prod territory')
+
 
 class GameMap:
     """Hold prod, strn and owners as separate x*y numpy matrices
@@ -22,33 +32,67 @@ class GameMap:
     def __init__(self):
         self.my_id = int(get_string())
         size_string = get_string()
-        prod_string = get_string()
+        prod_string = get_bytes()
 
         self.width, self.height = tuple(map(int, size_string.split()))
 
-        prod = [int(p) for p in prod_string.split()]
-        self.prod = np.array(prod, dtype=int).reshape((self.height, self.width)).T
+        prod = parse_ints(prod_string)
+        self.prod = np.ascontiguousarray(prod.reshape((self.height, self.width)).T)
+
+        # owners and strn for this frame and the last, swapped per frame
+        # and never edited; self.strn is this turn's copy to edit
+        self.frames = DoubleBuffer((self.width, self.height), ('owners', 'strn'))
+        self.diff = FrameDiff((self.width, self.height))
+        self.strn = np.zeros((self.width, self.height), dtype=int)
 
         self.get_frame()
 
     def get_frame(self, map_string=None):
+        """Read and decode a frame. The parse is timed (reading the line
+        is not) and kept in self.parse_time; self.frame_time is when the
+        line was in, which is where the turn's clock starts. self.diff
+        holds what changed since the previous frame (the first frame is
+        diffed against an empty, all-zero map), and strn_edited whether
+        the last turn edited its strn.
+        """
         if map_string is None:
-            map_string = get_string()
+            map_string = get_bytes()
+
+        start = self.frame_time = time.perf_counter()
+        self.strn_edited = not np.array_equal(self.strn, self.frames.cur['strn'])
+        self.frames.swap()
+        self.owners = self.frames.cur['owners']
+        self.prev_owners, self.prev_strn = self.frames.prev['owners'], self.frames.prev['strn']
+        decode_frame(map_string, self.width, self.height,
+                     out=(self.owners, self.frames.cur['strn']))
+        np.copyto(self.strn, self.frames.cur['strn'])
+        self.parse_time = time.perf_counter() - start
+        logging.debug('frame parsed in %.3fms', self.parse_time * 1000)
 
-        split_string = map_string.split()
-        owners = np.zeros(self.width * self.height, dtype=int)
+        self.diff.update(self.frames)
 
-        ctr, strloc = 0, 0
-        while ctr < self.width * self.height:
-            increment = int(split_string[strloc])
-            owner_id = int(split_string[strloc + 1])
-            owners[ctr:(ctr + increment)] = owner_id
-            ctr += increment
-            strloc += 2
-        self.owners = owners.reshape((self.height, self.width)).T
 
-        strn = [int(s) for s in split_string[strloc:]]
-        self.strn = np.array(strn, dtype=int).reshape((self.height, self.width)).T
+def parse_ints(s):
+    """Parse a whitespace separated line of ints in a single call."""
+    return np.fromstring(s, dtype=int, sep=' ')
+
+
+def decode_frame(map_string, w, h, out=None):
+    """Split a frame line into x*y owners and strn matrices.
+    The last w*h tokens are strengths; everything before them is
+    (count, owner) run-length pairs. If out is an (owners, strn) pair
+    of x*y arrays the frame is written into them instead.
+    """
+    tokens = parse_ints(map_string)
+    runs, strn = tokens[:-(w * h)], tokens[-(w * h):]
+    owners = np.repeat(runs[1::2], runs[0::2])
+
+    if out is None:
+        out = np.empty((w, h), dtype=int), np.empty((w, h), dtype=int)
+    np.copyto(out[0], owners.reshape((h, w)).T)
+    np.copyto(out[1], strn.reshape((h, w)).T)
+
+    return out
 
 
 def send_string(s):
@@ -57,8 +101,12 @@ def send_string(s):
     sys.stdout.flush()
 
 
+def get_bytes():
+    return sys.stdin.buffer.readline()
+
+
 def get_string():
-    return sys.stdin.readline().rstrip('\n')
+    return get_bytes().decode().rstrip('\n')
 
 
 def send_init(name):
@@ -70,148 +118,328 @@ def send_frame(moves):
                          for move in moves))
 
 
+def encode_ints(values):
+    """The inverse of parse_ints for non-negative ints: a space
+    separated line as bytes, built digit by digit for every value at
+    once.
+    """
+    values = np.asarray(values, dtype=int).ravel()
+    if not len(values):
+        return b''
+    width = len(str(values.max()))
+    powers = 10 ** np.arange(width - 1, -1, -1)
+
+    out = np.full((len(values), width + 1), ord(' '), dtype=np.uint8)
+    out[:, :width] = (values[:, None] // powers) % 10 + ord('0')
+    shown = np.ones(out.shape, dtype=bool)
+    shown[:, :width] = (values[:, None] >= powers) | (powers == 1)
+    return out[shown].tobytes()[:-1]
+
+
+def send_bytes(line):
+    sys.stdout.buffer.write(line + b'\n')
+    sys.stdout.buffer.flush()
+
+
 BIGINT = 99999
 
 
 class ImprovedGameMap(GameMap):
-    """Extend the base GameMap with extra information."""
-    def __init__(self, com_radius):
+    """Extend the base GameMap with extra information.
+    Derived layers are nodes of a LayerGraph (the @layer methods below):
+    each is computed the first time it is read in a turn and kept until
+    one of its inputs changes.
+    """
+
+    # Every preallocated layer and its dtype, overwritten in place.
+    LAYERS = {
+        'owned': int, 'blank': bool, 'enemy': int,
+        'ostrn': int, 'oprod': int, 'strnc': int, 'prodc': int,
+        'smooth_value': float, 'wall': bool, 'blank_zero': bool,
+        'splash_dmg': int, 'splash_prod': int, 'combat_heur': int,
+        'strong': int, 'ubrdr': int, 'obrdr': int, 'str_brdr': int,
+        'ebrdr': int, 'e_can_capture': int, 'target_cells': int,
+        'ubrdr_combat': int, 'melee_mat': int, 'close_to_combat': int,
+        'nearest_melee': int, 'dist_from_combat': int, 'noncombat': int,
+        'weakest_nbr': int, 'gte_nbr': bool, 'blank_valuable': bool,
+        'Mbval': float, 'enemy_walls': int, 'safe_to_take': int,
+    }
+
+    # Layers the movers read every turn after strn may have been edited
+    FRAME_LAYERS = (
+        'safe_to_take', 'combat_heur', 'strnc', 'wall', 'gte_nbr', 'Mbval',
+        'close_to_combat', 'noncombat', 'ubrdr_locs',
+    )
+
+    # Maps with more cells than this solve shortest paths lazily
+    EAGER_PATHS_CELLS = 30 * 30
+
+    def __init__(self, com_radius, lazy_paths=None):
+        """lazy_paths solves strength-weighted shortest paths from
+        border cells as calc_bval first needs them instead of all-pairs
+        up front; by default it is on for maps over EAGER_PATHS_CELLS
+        cells, where all-pairs takes seconds of the init time.
+        """
         super().__init__()
         self.dists = self.get_distances(self.width, self.height)
         self.nbrs = self.get_neighbours(self.width, self.height)
-        self.oneaways = self.get_oneaways(self.width, self.height)
+        self.nbr_idx = self.get_neighbour_index(self.width, self.height)
+        self.oneaway_idx = self.get_neighbour_index(self.width, self.height, 2)
         self.turn = -1
 
-        self.sp = ShortestPather(self.strn, self.prod)
-        self.str_to = self.sp.get_dist_matrix()
-        self.str_to = np.maximum(self.strn, self.str_to)
+        if lazy_paths is None:
+            lazy_paths = self.width * self.height > self.EAGER_PATHS_CELLS
+        start = time.perf_counter()
+        self.sp = ShortestPather(self.strn, self.prod, lazy=lazy_paths)
+        logging.debug('shortest paths: %.0fms, %.1fMB',
+                      (time.perf_counter() - start) * 1000, self.sp.nbytes / 1e6)
 
         self.original_strn = self.strn.copy()
+        self.str_to = FlooredPaths(self.sp, self.original_strn)
+        self.nearest = NearestBorders(self.sp)
+        self.borders = BorderTracker(self)
 
         self.parity = 0
         self.com_radius = com_radius
 
         self.last_turn = np.floor(np.sqrt(self.width * self.height) * 10)
 
+        self.layers = LayerStore((self.width, self.height))
+        self.graph = LayerGraph(self, self.LAYERS)
+
+    def __getattr__(self, name):
+        graph = self.__dict__.get('graph')
+        if graph is None or name not in graph.outputs:
+            raise AttributeError(name)
+        graph.compute(graph.outputs[name])
+        return self.__dict__[name]
+
     def update(self):
-        """Derive everything that changes per frame."""
+        """Start a new frame. Layers downstream of whatever changed are
+        dropped, and those in FRAME_LAYERS rebuilt here so they see the
+        frame as it arrived (MoveMaker edits strn in place later in the
+        turn). Anything else is built the first time it is read.
+        """
+        if self.graph.times:
+            logging.debug('layer times: ' + ', '.join(
+                '%s %.2fms' % (name, t * 1000) for name, t in self.graph.report()))
+            self.graph.times.clear()
+
         self.turn += 1
-        self.owned = (self.owners == self.my_id).astype(int)
-        self.blank = self.owners == 0
-        self.enemy = np.ones_like(self.owned) - self.owned - self.blank
-
-        # Owned prod and strn
-        self.ostrn = self.strn * self.owned
-        self.oprod = self.prod * self.owned
-
-        # Lower capped prod and strn
-        self.strnc = np.maximum(1, self.strn)
-        self.prodc = np.maximum(1, self.prod)
-
-        self.wall = self.blank * (self.strn > 0)
-
-        self.splash_dmg = self.plus_filter(self.strn * self.enemy, sum)
-        self.splash_prod = self.plus_filter(self.prod * self.enemy * (self.strn == 0),
-                                            sum)
-        self.combat_heur = self.splash_dmg + \
-            (self.prodc * self.blank * (self.strn == 0)) + \
-            (self.prodc * self.enemy * 2) + \
-            (self.enemy * 2) + (self.blank * (self.strn == 0)) + \
-            self.splash_prod
-
-        # Unowned border cells
-        self.ubrdr = self.plus_filter(self.owned, max) - self.owned
-        self.obrdr = self.plus_filter(self.ubrdr, max) - self.ubrdr
-        self.str_brdr = self.plus_filter(
-            (self.strn > 200) * self.owned, max
-        ) * self.owned
-        # self.havens = np.maximum(self.str_brdr, self.obrdr)
+        self.graph.touch('turn')
+        if len(self.diff.owner_idx):
+            self.graph.touch('owners')
+        if len(self.diff.strn_idx) or self.strn_edited:
+            self.graph.touch('strn')
+        self.graph.new_frame()
+
+        for name in self.FRAME_LAYERS:
+            self.graph.ensure(name)
+
+    @layer('owned', 'blank', 'enemy', inputs=('owners',))
+    def calc_ownership(self):
+        np.equal(self.owners, self.my_id, out=self.owned)
+        np.equal(self.owners, 0, out=self.blank)
+        np.subtract(1, self.owned, out=self.enemy)
+        np.subtract(self.enemy, self.blank, out=self.enemy)
+
+    @layer('ostrn', 'oprod', inputs=('strn', 'owned'))
+    def calc_owned_totals(self):
+        """Owned prod and strn."""
+        np.multiply(self.strn, self.owned, out=self.ostrn)
+        np.multiply(self.prod, self.owned, out=self.oprod)
+
+    @layer('strnc', inputs=('strn',))
+    def calc_strnc(self):
+        """Lower capped strn."""
+        np.maximum(self.strn, 1, out=self.strnc)
+
+    @layer('prodc', static=True)
+    def calc_prodc(self):
+        """Lower capped prod."""
+        np.maximum(self.prod, 1, out=self.prodc)
+
+    @layer('smooth_value', inputs=('prodc',), static=True)
+    def calc_smooth_value(self):
+        """Production value of the map as it started, blurred."""
+        gaussian_filter(self.prodc ** 2 / self.original_strn, 1.2,
+                        mode='wrap', output=self.smooth_value)
+
+    @layer('oneaways')
+    def calc_oneaways(self):
+        self.oneaways = self.get_oneaways(self.width, self.height)
 
-        # Enemy borders
-        self.ebrdr = self.plus_filter(self.enemy, max) - self.enemy
-        self.ebrdr_locs = np.transpose(np.nonzero(self.ebrdr))
-        self.e_can_capture = np.zeros_like(self.ebrdr)
-        for ex, ey in self.ebrdr_locs:
-            nbrs = [True for nx, ny in self.nbrs[ex, ey]
-                    if self.enemy[nx, ny] and
-                    self.strn[nx, ny] > self.strn[ex, ey]]
-            if len(nbrs):
-                self.e_can_capture[ex, ey] = True
-
-        self.owned_locs = np.transpose(np.nonzero(self.owned))
-        self.ubrdr_locs = np.transpose(np.nonzero(self.ubrdr))
-
-        # Combat cells
-        self.target_cells = self.enemy + (self.blank * (self.strn == 0))
-        self.ubrdr_combat = self.ubrdr * self.target_cells
-        self.melee_mat = self.plus_filter(self.ubrdr_combat, max) * self.owned
-
-        self.close_to_combat = self.melee_mat.copy()
-        for i in range(self.com_radius):
-            self.close_to_combat = np.maximum(
-                self.close_to_combat, self.plus_filter(self.close_to_combat, max)
-            )
-        self.close_to_combat -= self.melee_mat
-        self.close_to_combat *= self.owned
+    @layer('wall', 'blank_zero', inputs=('blank', 'strn'))
+    def calc_walls(self):
+        """Blank cells with and without strength."""
+        np.greater(self.strn, 0, out=self.wall)
+        np.logical_and(self.wall, self.blank, out=self.wall)
+        np.logical_xor(self.blank, self.wall, out=self.blank_zero)
+
+    @layer('splash_dmg', 'splash_prod', inputs=('strn', 'enemy'))
+    def calc_splash(self):
+        tmp = self.layers('tmp_splash')
+        np.multiply(self.strn, self.enemy, out=tmp)
+        self.plus_filter(tmp, sum, out=self.splash_dmg)
+        np.multiply(self.prod, self.enemy, out=tmp)
+        np.multiply(tmp, self.strn == 0, out=tmp)
+        self.plus_filter(tmp, sum, out=self.splash_prod)
+
+    # Combatant divides cells of this down as it picks targets, so it is
+    # rebuilt every turn.
+    @layer('combat_heur', inputs=('splash_dmg', 'splash_prod', 'prodc',
+                                  'blank_zero', 'enemy', 'turn'))
+    def calc_combat_heur(self):
+        """splash_dmg + prodc * blank_zero + (prodc + 1) * enemy * 2 +
+        blank_zero + splash_prod
+        """
+        tmp = self.layers('tmp_combat_heur')
+        np.multiply(self.prodc, self.blank_zero, out=self.combat_heur)
+        np.add(self.combat_heur, self.splash_dmg, out=self.combat_heur)
+        np.add(self.prodc, 1, out=tmp)
+        np.multiply(tmp, self.enemy, out=tmp)
+        np.multiply(tmp, 2, out=tmp)
+        np.add(self.combat_heur, tmp, out=self.combat_heur)
+        np.add(self.combat_heur, self.blank_zero, out=self.combat_heur)
+        np.add(self.combat_heur, self.splash_prod, out=self.combat_heur)
+
+    @layer('target_cells', inputs=('enemy', 'blank_zero'))
+    def calc_target_cells(self):
+        np.add(self.enemy, self.blank_zero, out=self.target_cells)
+
+    @layer('ubrdr', 'obrdr', 'ebrdr', 'ubrdr_combat', 'melee_mat',
+           'owned_locs', 'ubrdr_locs', 'ebrdr_locs',
+           inputs=('owned', 'enemy', 'target_cells'))
+    def calc_borders(self):
+        """Border and combat cells, recomputed only around changes."""
+        self.borders.update()
+        self.owned_locs = self.borders.owned_locs
+        self.ubrdr_locs = self.borders.ubrdr_locs
+        self.ebrdr_locs = self.borders.ebrdr_locs
+
+    @layer('strong', 'str_brdr', inputs=('strn', 'owned'))
+    def calc_str_brdr(self):
+        np.greater(self.strn, 200, out=self.strong)
+        np.multiply(self.strong, self.owned, out=self.strong)
+        self.plus_filter(self.strong, max, out=self.str_brdr)
+        np.multiply(self.str_brdr, self.owned, out=self.str_brdr)
+        # self.havens = np.maximum(self.str_brdr, self.obrdr)
 
+    @layer('e_can_capture', inputs=('ebrdr', 'enemy', 'strn'))
+    def calc_e_can_capture(self):
+        """Enemy border cells a neighbouring enemy piece can take."""
+        stronger = self.nbr_stack(self.strn) > self.strn[..., None]
+        stronger &= self.nbr_stack(self.enemy) != 0
+        np.multiply(stronger.any(axis=2), self.ebrdr, out=self.e_can_capture)
+
+    @layer('player_stats', inputs=('owners', 'strn'))
+    def calc_player_stats(self):
+        """Strength, production and cell count of every player (and of
+        blank cells, as player 0) in one pass over the map.
+        """
+        owners = self.owners.ravel()
+        size = max(owners.max(), self.my_id) + 1
+        self.player_stats = PlayerStats(
+            np.bincount(owners, self.strn.ravel(), size).astype(int),
+            np.bincount(owners, self.prod.ravel(), size).astype(int),
+            np.bincount(owners, minlength=size),
+        )
+
+    @layer('dist_from_combat', inputs=('owned', 'target_cells', 'ubrdr_combat'))
+    def calc_dist_from_combat(self):
+        """Friendly distance to combat, only out to one step past
+        com_radius (further cells are -1 like unreachable ones): that
+        covers close_to_combat and the cells its pieces can step to.
+        """
         if self.target_cells.max() > 0:
-            self.dist_from_combat = friendly_to(
+            friendly_to(
                 self,
-                np.transpose(np.nonzero(self.ubrdr_combat))
+                np.transpose(np.nonzero(self.ubrdr_combat)),
+                out=self.dist_from_combat,
+                max_dist=self.com_radius + 1
             )
         else:
-            self.dist_from_combat = np.zeros_like(self.target_cells)
-
-        self.close_to_combat[self.dist_from_combat > self.com_radius] = False
-        self.noncombat = self.owned - self.close_to_combat - self.melee_mat
-
-        # Whether cells are stronger than their weakest neighbour
-        targets = self.strn * self.blank
-        targets[targets == 0] = 256
-        self.weakest_nbr = self.plus_filter(targets, min)
-        self.gte_nbr = self.ostrn > self.weakest_nbr
-
-        self.calc_bval()
-        self.calc_aggs()
-
+            self.dist_from_combat.fill(0)
+
+    @layer('nearest_melee', inputs=('melee_mat',))
+    def calc_nearest_melee(self):
+        """Flat index of the closest melee cell to every cell."""
+        nearest_to(self, np.transpose(np.nonzero(self.melee_mat)),
+                   out=self.nearest_melee)
+
+    @layer('close_to_combat', inputs=('dist_from_combat',))
+    def calc_close_to_combat(self):
+        """Owned cells 2 to com_radius steps from combat through owned
+        cells (1 is melee_mat). A friendly path is never shorter than
+        one over the open torus, so these are also within com_radius
+        of melee_mat.
+        """
+        mask = self.layers('mask_close', bool)
+        np.greater_equal(self.dist_from_combat, 2, out=mask)
+        np.less_equal(self.dist_from_combat, self.com_radius,
+                      out=self.close_to_combat)
+        np.multiply(self.close_to_combat, mask, out=self.close_to_combat)
+
+    @layer('noncombat', inputs=('owned', 'close_to_combat', 'melee_mat'))
+    def calc_noncombat(self):
+        np.subtract(self.owned, self.close_to_combat, out=self.noncombat)
+        np.subtract(self.noncombat, self.melee_mat, out=self.noncombat)
+
+    @layer('weakest_nbr', 'gte_nbr', inputs=('strn', 'blank', 'ostrn'))
+    def calc_weakest_nbr(self):
+        """Whether cells are stronger than their weakest neighbour."""
+        tmp = self.layers('tmp_weakest')
+        np.multiply(self.strn, self.blank, out=tmp)
+        np.copyto(tmp, 256, where=tmp == 0)
+        self.plus_filter(tmp, min, out=self.weakest_nbr)
+        np.greater(self.ostrn, self.weakest_nbr, out=self.gte_nbr)
+
+    # Reads turn and is edited in place by MoveMaker, so always rebuilt.
+    @layer('enemy_walls', 'safe_to_take', 'total_strn', 'num_enemies',
+           'total_enemy_strn', 'ave_enemy_strn', 'in_combat',
+           inputs=('turn', 'player_stats', 'strn', 'owned', 'enemy',
+                   'wall', 'melee_mat', 'e_can_capture', 'ebrdr', 'obrdr'))
     def calc_aggs(self):
-        self.total_strn = self.ostrn.sum() + (self.oprod.sum() / 2)
-        self.num_enemies = max(1, len(np.unique(self.owners)) - 2)
-        self.total_enemy_strn = (self.strn * self.enemy).sum()
+        tmp, mask = self.layers('tmp_aggs'), self.layers('mask_aggs', bool)
+
+        stats = self.player_stats
+        self.total_strn = stats.strn[self.my_id] + (stats.prod[self.my_id] / 2)
+        self.num_enemies = max(1, np.count_nonzero(stats.territory) - 2)
+        self.total_enemy_strn = stats.strn.sum() - stats.strn[0] - \
+            stats.strn[self.my_id]
         self.ave_enemy_strn = self.total_enemy_strn / self.num_enemies
 
         self.in_combat = self.melee_mat.max()
 
-        self.enemy_walls = (self.blank * (self.strn > 0)) * \
-            self.plus_filter(self.enemy, max)
+        self.plus_filter(self.enemy, max, out=self.enemy_walls)
+        np.multiply(self.enemy_walls, self.wall, out=self.enemy_walls)
 
         if not self.in_combat and self.total_strn < (2.0 * self.ave_enemy_strn) and \
                 (self.turn - 5) < self.last_turn:
-            self.enemy_walls += \
-                self.plus_filter(self.e_can_capture, max) - \
-                self.owned
-            self.enemy_walls = np.minimum(1, self.enemy_walls)
+            self.plus_filter(self.e_can_capture, max, out=tmp)
+            np.subtract(tmp, self.owned, out=tmp)
+            np.add(self.enemy_walls, tmp, out=self.enemy_walls)
+            np.minimum(1, self.enemy_walls, out=self.enemy_walls)
 
-        self.safe_to_take = 1 - self.enemy_walls
+        np.subtract(1, self.enemy_walls, out=self.safe_to_take)
 
         if not self.in_combat and self.total_strn > (2.0 * self.ave_enemy_strn):
-            min_str = np.min([self.strn[x, y]
-                             for (x, y) in np.transpose(np.nonzero(self.enemy_walls))])
-            self.enemy_walls[self.strn == min_str] = False
-            self.safe_to_take[self.strn == min_str] = True
+            min_str = self.strn[self.enemy_walls != 0].min()
+            np.equal(self.strn, min_str, out=mask)
+            np.copyto(self.enemy_walls, 0, where=mask)
+            np.copyto(self.safe_to_take, 1, where=mask)
 
         # if self.turn == self.last_turn:
         #     self.safe_to_take.fill(True)
 
         if self.in_combat and self.num_enemies == 1:
-            brdr_str = [
-                self.strn[x, y] for (x, y) in self.ebrdr_locs
-                if self.obrdr[x, y]
-            ]
+            np.multiply(self.ebrdr, self.obrdr, out=tmp)
+            brdr_str = self.strn[tmp != 0]
             if len(brdr_str):
                 min_brdr_str = np.min(brdr_str)
-                self.enemy_walls[self.strn == min_brdr_str] = False
-                self.safe_to_take[self.strn == min_brdr_str] = True
+                np.equal(self.strn, min_brdr_str, out=mask)
+                np.copyto(self.enemy_walls, 0, where=mask)
+                np.copyto(self.safe_to_take, 1, where=mask)
 
         # if self.in_combat and self.num_enemies == 1:
         #     self.safe_to_take.fill(True)
@@ -232,54 +460,59 @@ class ImprovedGameMap(GameMap):
         # else:
         #     self.safe_to_take = np.ones_like(self.enemy_walls)
 
+    @layer('Mbval', 'blank_valuable', inputs=('prodc', 'strnc', 'wall', 'ubrdr'))
     def calc_bval(self):
-        """The border expansion heuristic, leveraging dijkstra's algorithm."""
-        blank_valuable = self.blank * (((self.prodc ** 2) / self.strnc) > 0.0) * \
-            (self.strn > 0)
-        Bis = self.ubrdr.flatten().nonzero()[0]
-        Uis = blank_valuable.flatten().nonzero()[0]
-        Uprod = self.prodc.flatten()[Uis]
-        Ustrn = self.strnc.flatten()[Uis]
+        """The border expansion heuristic, leveraging dijkstra's algorithm.
+        Closest border cells per target are carried over from the last
+        call by self.nearest, see NearestBorders.
+        """
+        ratio = self.layers('tmp_bval', float)
+        np.square(self.prodc, out=ratio)
+        np.divide(ratio, self.strnc, out=ratio)
+        np.greater(ratio, 0.0, out=self.blank_valuable)
+        np.logical_and(self.blank_valuable, self.wall, out=self.blank_valuable)
+
+        ubrdr, valuable = self.ubrdr.ravel(), self.blank_valuable.ravel()
+        B_cells = self.borders.ubrdr_changed
+        if self.nearest.Bis is None or B_cells is None:
+            keys, Umin = self.nearest.solve(np.flatnonzero(ubrdr),
+                                            np.flatnonzero(valuable))
+        else:
+            # Targets only change where owners or strn did
+            U_cells = np.union1d(self.diff.owner_idx, self.diff.strn_idx)
+            keys, Umin = self.nearest.update(B_cells, ubrdr[B_cells] != 0,
+                                             U_cells, valuable[U_cells])
+        Bis, Uis = self.nearest.Bis, self.nearest.Uis
+
+        self.Mbval.fill(0)
+        if not len(Bis) or not len(Uis):
+            self.nearest.reset()
+            return
+
+        Uprod = self.prodc.ravel()[Uis]
+        Ustrn = self.strnc.ravel()[Uis]
         Ustrn[Ustrn == 0] = 20  # Quick hack
 
-        Bvals = np.zeros(len(Bis), dtype=float)
-        self.Mbval = np.zeros_like(self.prod, dtype=float)
+        # Each target is worth Uval / (dist + Ustrn / Uprod + 1) to every
+        # border cell tied for closest to it.
+        dist_bu = Umin + Ustrn / Uprod + 1
+        credit = ((Uprod ** 2) / Ustrn) / dist_bu
 
-        D_BU = self.sp.path[Bis][:, Uis]
-        D_BU_min = D_BU.min(axis=0)
-        for i, min_ in enumerate(D_BU_min):
-            dist_bu = D_BU[:, i][np.where(D_BU[:, i] == min_)] + Ustrn[i] / Uprod[i] + 1
-
-            Bvals[np.where(D_BU[:, i] == min_)] += ((Uprod[i] ** 2) / Ustrn[i]) / dist_bu
-
-        for i, Bi in enumerate(Bis):
-            bx, by = self.sp.vertices[Bi]
-            self.Mbval[bx, by] += Bvals[i]
+        n = self.width * self.height
+        np.add.at(self.Mbval.reshape(-1), keys // n,
+                  credit[np.searchsorted(Uis, keys % n)])
 
     @staticmethod
     def get_distances(w, h):
-        """Populate a 4-dimensional np.ndarray where:
-            arr[x, y, a, b]
+        """Build the distance lookup where:
+            dists[x, y, a, b]
         yields the shortest distance between (x, y) and (a, b).
         Indexing as:
-            arr[x, y]
+            dists[x, y]
         yields a 2D array of the distances from (x, y) to every
-        other cell.
+        other cell. See TorusDistances.
         """
-        base_dists = np.zeros((w, h), dtype=int)
-        all_dists = np.zeros((w, h, w, h), dtype=int)
-
-        for x in range(w):
-            for y in range(h):
-                min_x = min((x - 0) % w, (0 - x) % w)
-                min_y = min((y - 0) % h, (0 - y) % h)
-                base_dists[x, y] = max(min_x + min_y, 1)
-
-        for x in range(w):
-            for y in range(h):
-                all_dists[x, y] = np.roll(np.roll(base_dists, x, 0), y, 1)
-
-        return all_dists
+        return TorusDistances(w, h)
 
     @staticmethod
     def get_neighbours(w, h):
@@ -314,25 +547,49 @@ class ImprovedGameMap(GameMap):
         return nbrs
 
     @staticmethod
-    def plus_filter(X, f):
+    def get_neighbour_index(w, h, step=1):
+        """Populate a (w*h, 4) int32 array where row x*h + y holds the
+        flat indices of the cells step away from (x, y), ordered
+        N, E, S, W. Flat indices match X.ravel() and
+        ShortestPather.get_vertex.
+        """
+        x, y = np.divmod(np.arange(w * h), h)
+        idx = np.empty((w * h, 4), dtype=np.int32)
+        idx[:, 0] = x * h + (y - step) % h
+        idx[:, 1] = ((x + step) % w) * h + y
+        idx[:, 2] = x * h + (y + step) % h
+        idx[:, 3] = ((x - step) % w) * h + y
+        return idx
+
+    def nbr_stack(self, X, out=None, idx=None):
+        """Gather the N, E, S, W neighbours of every cell of X into a
+        (w, h, 4) array, so that
+            nbr_stack(X)[x, y, i] == X[gm.nbrs[x, y][i]]
+        Pass idx=gm.oneaway_idx for the cells two away instead. The
+        result is written to out if given.
+        """
+        idx = self.nbr_idx if idx is None else idx
+        if out is None:
+            out = np.empty((self.width, self.height, 4), dtype=X.dtype)
+        np.take(X.ravel(), idx, out=out.reshape(idx.shape), mode='clip')
+        return out
+
+    @staticmethod
+    def plus_filter(X, f, out=None):
         """Scans a +-shaped filter over the input matrix X, applies
         the reducer function f and returns a new matrix with the same
-        dimensions of X containing the reduced values.
+        dimensions of X containing the reduced values. f is one of
+        sum, max, min or any (or their names); see stencil.torus_filter.
+        The result is written to out if given.
         """
-        footprint = np.array([[0, 1, 0],
-                              [1, 1, 1],
-                              [0, 1, 0]])
-        proc = generic_filter(X, f, footprint=footprint, mode='wrap')
-        return proc
+        return torus_filter(X, PLUS, f, out)
 
     @staticmethod
-    def square_filter(X, f):
+    def square_filter(X, f, out=None):
         """Scans a square-shaped filter over the input matrix X, applies
         the reducer function f and returns a new matrix with the same
-        dimensions of X containing the reduced values.
+        dimensions of X containing the reduced values. f is one of
+        sum, max, min or any (or their names); see stencil.torus_filter.
+        The result is written to out if given.
         """
-        footprint = np.array([[1, 1, 1],
-                              [1, 1, 1],
-                              [1, 1, 1]])
-        proc = generic_filter(X, f, footprint=footprint, mode='wrap')
-        return proc
+        return torus_filter(X, SQUARE, f, out)
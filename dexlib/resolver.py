@@ -1,8 +1,10 @@
 """Highly mechanical class that takes care of avoiding the cap."""
 
 
+import copy
+import heapq
 import numpy as np
-from dexlib.find_path import find_pref_next
+from dexlib.find_path import find_pref_nexts, safe_steps
 
 
 import logging
@@ -12,230 +14,284 @@ logging.basicConfig(filename='wtf.info', level=logging.DEBUG, filemode="w")
 class Resolver:
     """Handle str cap avoiding, patch mechanics, etc."""
 
+    # Rounds a group is decided in at once before settle goes piece by
+    # piece
+    settle_rounds = 16
+
     def __init__(self, gm, strlim=255):
         self.strlim = strlim
 
     def resolve(self, gm, moveset):
+        """Turn every piece's target into a move without going over the
+        strength cap. On-parity pieces go first, strongest first, each
+        taking its first preferred step, else its second, if the
+        strength already sent there leaves room. Melee pieces that fit
+        nowhere stay and push at their best combat cell; the rest dodge
+        after the off-parity pieces.
+
+        Every decision only depends on the strength sent to a piece's
+        cell and its neighbours by the pieces before it, so each of the
+        three groups is decided at once from a guess, the strength sent
+        to each cell is added up for the whole group, and the pieces
+        that strength changed for are decided again until it stops
+        changing. That is the same fixed point as deciding them one at
+        a time, see settle.
+        """
         # I don't do anything about over-growing the cap, but can I even.
         moveset.set_stays()
 
-        pstrn_map = np.zeros_like(gm.strn)
-
-        on_moves = {(ax, ay): v for (ax, ay), v in moveset.move_dict.items()
-                    if ((ax + ay + gm.turn) % 2 == gm.parity)}  # or gm.noncombat[ax, ay]}
-        off_moves = {(ax, ay): v for (ax, ay), v in moveset.move_dict.items()
-                     if ((ax + ay + gm.turn) % 2 != gm.parity)}  # and not gm.noncombat[ax, ay]}
+        locs = moveset.decided_locs()
+        targets = np.transpose(np.divmod(moveset.target[locs[:, 0], locs[:, 1]],
+                                         gm.height))
+        on_parity = (locs.sum(axis=1) + gm.turn) % 2 == gm.parity  # or gm.noncombat
 
         if (gm.turn < 40 and not gm.in_combat) or gm.turn == gm.last_turn:
-            on_moves = moveset.move_dict
-            off_moves = {}
-
-        # Handle all the black squares going where they need to be
-        on_origins = list(on_moves.keys())
-        on_targets = list(on_moves.values())
-        on_strns = [gm.strn[x, y] for (x, y) in on_origins]
-        # on_dists = [gm.dists[x, y, a, b] - (gm.strn[x, y] / 1000)
-        #             for ((x, y), (a, b, _)) in zip(on_origins, on_targets)]
-        str_sort = np.argsort(on_strns)
-
-        for i in str_sort[::-1]:
-            ax, ay = on_origins[i]
-            tx, ty, _ = on_targets[i]
-            istrn = on_strns[i]
-            strlim_cell = max(istrn, self.strlim)
-
-            if gm.close_to_combat[ax, ay] and not (ax == tx and ay == ty):
-                d2c = gm.dist_from_combat[ax, ay]
-                choices = []
-                cdists = []
-                for i, (nx, ny) in enumerate(gm.nbrs[ax, ay]):
-                    if gm.dist_from_combat[nx, ny] < d2c and not gm.wall[nx, ny]:
-                        choices.append((nx, ny, i + 1))
-                        cdists.append(gm.dists[tx, ty, nx, ny] + gm.prod[nx, ny] * 0.01)
-
-                if len(choices) == 2:
-                    argsort = np.argsort(cdists)
-                    best = argsort[0]
-                    secnd = argsort[1]
-                    (px1, py1, d1), (px2, py2, d2) = choices[best], choices[secnd]
-                elif len(choices):
-                    (px1, py1, d1), (px2, py2, d2) = choices[0], (None, None, None)
-                else:
-                    (px1, py1, d1), (px2, py2, d2) = (ax, ay, 0), (None, None, None)
-
-                # logging.debug(((ax, ay), choices))
-            else:
-                (px1, py1, d1), (px2, py2, d2) = find_pref_next(ax, ay, tx, ty, gm)
-
-            if (istrn + pstrn_map[px1, py1]) <= strlim_cell:  # and \
-                    #  ((gm.strn[px1, py1] + gm.prod[px1, py1]) < istrn or
-                    #    gm.owned[px1, py1] == 0):
-                moveset.add_move(ax, ay, px1, py1, d1)
-                pstrn_map[px1, py1] += istrn
-
-                # logging.info(('Priority:', ax, ay, px1, py1, istrn, pstrn_map[px1, py1]))
-                # logging.debug(((ax, ay), 'to', (d1), 'firstpick'))
-            elif px2 is not None and (istrn + pstrn_map[px2, py2]) <= strlim_cell:  # and \
-                    #  ((gm.strn[px2, py2] + gm.prod[px2, py2]) < istrn or
-                    #    gm.owned[px2, py2] == 0):
-                moveset.add_move(ax, ay, px2, py2, d2)
-                pstrn_map[px2, py2] += istrn
-
-                # logging.info(('Priority:', ax, ay, px2, py2, istrn, pstrn_map[px2, py2]))
-                # logging.debug(((ax, ay), 'to', (d2), 'secpick'))
-            elif gm.melee_mat[ax, ay]:
-                nbrs = gm.nbrs[(ax, ay)]
-                scores = np.array([
-                    gm.combat_heur[nx, ny] * ((pstrn_map[nx, ny] + istrn) < strlim_cell)
-                    #  + (gm.wall[nx, ny] * -1000)
-                    for (nx, ny) in nbrs
-                ])
-
-                if scores.max() > 0:
-                    nx, ny = nbrs[scores.argmax()]
-                    dir_ = self.nxny_to_cardinal(gm, ax, ay, nx, ny)
-                    moveset.add_move(ax, ay, ax, ay, dir_)
-                    pstrn_map[nx, ny] += istrn + gm.prod[ax, ay]
-                else:
-                    moveset.add_move(ax, ay, ax, ay, 0)
-                    pstrn_map[ax, ay] += istrn + gm.prod[ax, ay]
-
-            else:
-                # moveset.add_move(ax, ay, ax, ay, 0)
-                # pstrn_map[ax, ay] += istrn + gm.prod[ax, ay]
-                off_moves[ax, ay] = tx, ty
-                # logging.debug(((ax, ay), 'to', (0), 'dodgeroo'))
-
-        # Handle all the white squares getting the heck out of the way
-        # Not iterating in any particular order!
-        for (ax, ay) in off_moves.keys():
-            d2c = gm.dist_from_combat[ax, ay]
-            istrn = gm.strnc[ax, ay]
-            iprod = gm.prod[ax, ay]
-            strlim_cell = max(istrn, self.strlim)
-
-            if pstrn_map[ax, ay] == 0:
-                moveset.add_move(ax, ay, ax, ay, 0)
-                pstrn_map[ax, ay] += istrn + iprod
-                # logging.info(('dodge', ax, ay, 'safe to stay1', istrn, pstrn_map[ax, ay]))
-
-            elif (pstrn_map[ax, ay] + istrn + iprod) <= strlim_cell:
-                moveset.add_move(ax, ay, ax, ay, 0)
-                pstrn_map[ax, ay] += istrn + iprod
-                # logging.info(('dodge', ax, ay, 'safe to stay2', istrn, pstrn_map[ax, ay]))
-
-            else:  # Dodge this!
-                # Check if it's better to just hang out
-                addable = 255 - pstrn_map[ax, ay] - istrn
-                if addable > istrn:
-                    moveset.add_move(ax, ay, ax, ay, 0)
-                    pstrn_map[ax, ay] += istrn + iprod
-                    # logging.info('dodge', ax, ay, 'safe to stay3')
-                    continue
-
-                nbrs = gm.nbrs[ax, ay]
-
-                # Find an enemy to hit!
-                # Can technically lose to cap here since I skip checking pstrn
-                enemy_strn = np.array([
-                    gm.enemy[nnx, nny] * gm.strn[nnx, nny]
-                    for (nnx, nny) in nbrs
-                ])
-                if enemy_strn.max() > 1:
-                    dir_ = enemy_strn.argmax() + 1
-                    nx, ny = nbrs[enemy_strn.argmax()]
-                    moveset.add_move(ax, ay, nx, ny, dir_)
-                    pstrn_map[nx, ny] += istrn
-                    # logging.info(('dodge', ax, ay, 'hitting enemy at', nx, ny))
-                    continue
-
-                # Find a blank square to damage!
-                # blank_strn = np.array([
-                #     gm.blank[nnx, nny] * gm.strnc[nnx, nny] * (gm.strnc[nnx, nny] < istrn) *
-                #     gm.safe_to_take[nnx, nny]
-                #     # * (gm.dist_from_combat[nnx, nny] >= d2c)
-                #     for (nnx, nny) in nbrs
-                # ])
-
-                # if blank_strn.max() > 0.5:
-                #     dir_ = blank_strn.argmax() + 1
-                #     nx, ny = nbrs[blank_strn.argmax()]
-                #     moveset.add_move(ax, ay, nx, ny, dir_)
-                #     pstrn_map[nx, ny] += istrn
-                #     # logging.info(('dodge', ax, ay, 'hitting blank', nx, ny))
-                #     continue
-
-                # Find a blank square to damage!
-                blank_strn = np.array([
-                    gm.blank[nnx, nny] * gm.prod[nnx, nny] * (gm.strnc[nnx, nny] < istrn) *
-                    gm.safe_to_take[nnx, nny]
-                    # * (gm.dist_from_combat[nnx, nny] >= d2c)
-                    for (nnx, nny) in nbrs
-                ])
-
-                if blank_strn.max() > 0.5:
-                    dir_ = blank_strn.argmax() + 1
-                    nx, ny = nbrs[blank_strn.argmax()]
-                    moveset.add_move(ax, ay, nx, ny, dir_)
-                    pstrn_map[nx, ny] += istrn
-                    # logging.info(('dodge', ax, ay, 'hitting blank', nx, ny))
-                    continue
-
-                # # Find somewhere to fit!
-                # can_fit = np.array([
-                #     gm.owned[nnx, nny] * ((pstrn_map[nnx, nny] + istrn) <= strlim_cell)
-                #     * gm.safe_to_take[nnx, nny]
-                #     * (gm.dist_from_combat[nnx, nny] >= 1)
-                #     * (1 / gm.prod[nnx, nny])
-                #     for (nnx, nny) in nbrs
-                # ])
-                # if can_fit.max() > 0:
-                #     # Need to make this favour the lower production option
-                #     dir_ = can_fit.argmax() + 1
-                #     nx, ny = nbrs[can_fit.argmax()]
-                #     moveset.add_move(ax, ay, nx, ny, dir_)
-                #     pstrn_map[nx, ny] += istrn
-                #     # logging.info(('dodge', ax, ay, 'can fit in', nx, ny))
-                #     continue
-
-                # Go to the weakest remaining square
-                owned_strn = np.array([
-                    gm.owned[nnx, nny] * (pstrn_map[nnx, nny] + gm.strn[nnx, nny])
-                    # + (gm.dist_from_combat[nnx, nny] < d2c) * 1000
-                    for (nnx, nny) in nbrs
-                ])
-                owned_strn[owned_strn == 0] = 999
-
-                dir_ = owned_strn.argmin() + 1
-                nx, ny = nbrs[owned_strn.argmin()]
-                moveset.add_move(ax, ay, nx, ny, dir_)
-                pstrn_map[nx, ny] += istrn
-                # logging.info(('dodge', ax, ay, 'owned strn', nx, ny))
-                continue
+            on_parity[:] = True
+
+        # Black squares strongest first
+        on_origins, on_targets = locs[on_parity], targets[on_parity]
+        on_strns = gm.strn[on_origins[:, 0], on_origins[:, 1]]
+        str_sort = np.argsort(on_strns)[::-1]
+        on_origins, on_targets = on_origins[str_sort], on_targets[str_sort]
+        first, second = self.step_prefs(gm, on_origins, on_targets)
+
+        sent_to = np.zeros(gm.width * gm.height, dtype=int)
+        on = self.Group(gm, on_origins, gm.strn, self.strlim)
+        on_to, on_dirs, dodge = self.settle(
+            on, sent_to, first,
+            lambda rows, pstrn: self.decide_on(gm, on.take(rows), pstrn,
+                                               first[rows], second[rows]))
+
+        # Then the white squares (not in any particular order), then the
+        # black squares that fit nowhere dodge
+        moves = [(on.origins[~dodge], on_to[~dodge], on_dirs[~dodge])]
+        for origins in (locs[~on_parity], on.origins[dodge]):
+            off = self.Group(gm, origins, gm.strnc, self.strlim)
+            off_to, = self.settle(
+                off, sent_to, np.zeros(len(origins), dtype=int),
+                lambda rows, pstrn: self.decide_off(gm, off.take(rows), pstrn))
+            moves.append((off.origins, off_to, off_to))
+
+        for origins, to, dirs in moves:
+            tx, ty = np.divmod(on.cells_of(gm, origins)[np.arange(len(to)), to],
+                               gm.height)
+            moveset.set_moves(origins[:, 0], origins[:, 1], tx, ty, dirs)
 
         return moveset
 
-    @staticmethod
-    def nxny_to_cardinal(gm, x, y, nx, ny):
-        dx, dy = (nx - x), (ny - y)
-        if dx == gm.width - 1:
-            dx = -1
-        if dx == -1 * (gm.width - 1):
-            dx = 1
-        if dy == gm.height - 1:
-            dy = -1
-        if dy == -1 * (gm.height - 1):
-            dy = 1
-
-        if (dx, dy) == (0, 0):
-            return 0
-        elif (dx, dy) == (0, -1):
-            return 1
-        elif (dx, dy) == (1, 0):
-            return 2
-        elif (dx, dy) == (0, 1):
-            return 3
-        elif (dx, dy) == (-1, 0):
-            return 4
+    def step_straight(self, gm, moveset):
+        """Stand-in for resolve when the turn is out of time: every
+        piece headed elsewhere that has no direction yet takes its
+        first preferred step there, with no care for the cap. Returns
+        the x and y arrays of those pieces.
+        """
+        own = np.arange(gm.width * gm.height).reshape(moveset.target.shape)
+        ax, ay = np.nonzero(moveset.decided & (moveset.dirs == 0) &
+                            (moveset.target != own))
+        tx, ty = np.divmod(moveset.target[ax, ay], gm.height)
+        (_, _, dirs), _ = find_pref_nexts(ax, ay, tx, ty, gm)
+        moveset.set_moves(ax, ay, tx, ty, dirs)
+        return ax, ay
+
+    class Group:
+        """Pieces decided together: origins in order, each piece's cell
+        and its N, E, S, W neighbours (so steps are 0-4 indices into
+        cells and equal to the direction sent), strength, cap and
+        production.
+        """
+
+        def __init__(self, gm, origins, strn, strlim):
+            self.origins = origins
+            self.cells = self.cells_of(gm, origins)
+            self.flat = self.cells[:, 0]
+            self.istrn = strn.ravel()[self.flat]
+            self.strlim = np.maximum(self.istrn, strlim)
+            self.prod = gm.prod.ravel()[self.flat]
+
+        def take(self, rows):
+            """The pieces at rows, as a group of their own."""
+            part = copy.copy(self)
+            for name in ('origins', 'cells', 'flat', 'istrn', 'strlim', 'prod'):
+                setattr(part, name, getattr(self, name)[rows])
+            return part
+
+        @staticmethod
+        def cells_of(gm, origins):
+            flat = origins[:, 0] * gm.height + origins[:, 1]
+            return np.concatenate((flat[:, None], gm.nbr_idx[flat]), axis=1)
+
+    def settle(self, group, sent_to, guess, decide):
+        """Decide group from the guessed steps until the strength they
+        send stops changing. sent_to is the strength sent to each cell
+        by earlier groups, and this group's is added to it. decide maps
+        (rows, pstrn) to (*moves, to, sent) for those rows of group and
+        settle returns moves.
+
+        After the first round only the pieces whose pstrn changed are
+        decided again. Piece i is final once pieces 0..i-1 are, so it
+        takes at most n rounds; past settle_rounds the pieces still to
+        redo are decided one at a time in order instead, which redoes
+        each of them at most once more.
+        """
+        cells, n = group.cells, len(group.cells)
+        to = guess.copy()
+        sent = np.where(guess == 0, group.istrn + group.prod, group.istrn)
+        before = self.strn_sent_before(cells, to, sent)
+        holders = self.holders(cells)
+        moves = []
+
+        def redecide(rows):
+            *new_moves, new_to, new_sent = decide(rows, sent_to[cells[rows]] + before[rows])
+            if not moves:
+                moves.extend(np.empty(n, dtype=move.dtype) for move in new_moves)
+            for move, new in zip(moves, new_moves):
+                move[rows] = new
+
+            changed = (new_to != to[rows]) | (new_sent != sent[rows])
+            rows = rows[changed]
+            dest = cells[rows, to[rows]]
+            redo = self.add_sent(before, holders, rows, dest, -sent[rows])
+            to[rows], sent[rows] = new_to[changed], new_sent[changed]
+            dest = cells[rows, to[rows]]
+            return np.union1d(redo, self.add_sent(before, holders, rows, dest, sent[rows]))
+
+        rows = np.arange(n)
+        for _ in range(self.settle_rounds):
+            rows = redecide(rows)
+            if not len(rows):
+                break
         else:
-            return 0
+            queued = np.zeros(n, dtype=bool)
+            queued[rows] = True
+            pending = list(rows)
+            while pending:
+                i = heapq.heappop(pending)
+                queued[i] = False
+                redo = redecide(np.array([i]))
+                redo = redo[~queued[redo]]
+                queued[redo] = True
+                for j in redo:
+                    heapq.heappush(pending, j)
+
+        np.add.at(sent_to, cells[np.arange(n), to], sent)
+        return moves
+
+    @staticmethod
+    def holders(cells):
+        """Every (row, column) of cells, sorted by the cell there."""
+        order = np.argsort(cells.ravel(), kind='stable')
+        return cells.ravel()[order], order // cells.shape[1], order % cells.shape[1]
+
+    @staticmethod
+    def add_sent(before, holders, pieces, dest, sent):
+        """Add sent[k], sent by pieces[k] to cell dest[k], to before
+        wherever a later piece has that cell. Returns those pieces.
+        """
+        held, row, col = holders
+        start = np.searchsorted(held, dest)
+        count = np.searchsorted(held, dest, side='right') - start
+        at = np.repeat(start - np.cumsum(count) + count, count) + np.arange(count.sum())
+        later = (row[at] > np.repeat(pieces, count)) & (np.repeat(sent, count) != 0)
+        np.add.at(before, (row[at][later], col[at][later]), np.repeat(sent, count)[later])
+        return np.unique(row[at][later])
+
+    @staticmethod
+    def strn_sent_before(cells, to, sent):
+        """pstrn[i, j], the strength sent to cells[i, j] by the pieces
+        before i, from prefix sums over the pieces sorted by cell.
+        """
+        n = len(cells)
+        dest = cells[np.arange(n), to]
+        keys = dest * n + np.arange(n)
+        order = np.argsort(keys)
+        total = np.concatenate(([0], np.cumsum(sent[order])))
+
+        start = np.searchsorted(keys[order], cells * n)
+        before = np.searchsorted(keys[order], cells * n + np.arange(n)[:, None])
+        return total[before] - total[start]
+
+    @staticmethod
+    def decide_on(gm, group, pstrn, first, second):
+        """Black squares: first pick, second pick, push at the best
+        combat cell in melee, else dodge. Returns (to, dirs, dodge,
+        to, sent); pushing pieces stay and send towards their push.
+        """
+        istrn, strlim, rows = group.istrn, group.strlim, np.arange(len(first))
+        fits1 = (istrn + pstrn[rows, first]) <= strlim
+        fits2 = (second >= 0) & \
+            ((istrn + pstrn[rows, np.maximum(second, 0)]) <= strlim)
+        melee = gm.melee_mat.ravel()[group.flat] != 0
+
+        push = gm.combat_heur.ravel()[group.cells[:, 1:]] * \
+            ((pstrn[:, 1:] + istrn[:, None]) < strlim[:, None])
+        pushes = melee & ~fits1 & ~fits2 & (push.max(axis=1, initial=0) > 0)
+        push_to = push.argmax(axis=1) + 1 if len(rows) else rows
+
+        to = np.where(fits1, first, np.where(fits2, second, 0))
+        sent_to = np.where(pushes, push_to, to)
+        dodge = ~fits1 & ~fits2 & ~melee
+        sent = np.where(fits1 | fits2, istrn, istrn + group.prod) * ~dodge
+        return to, sent_to, dodge, sent_to, sent
+
+    @staticmethod
+    def decide_off(gm, group, pstrn):
+        """White squares: stay if there is room, else hit an enemy,
+        damage a blank square or go to the weakest owned one. Returns
+        (to, to, sent).
+        """
+        istrn, prod, strlim = group.istrn, group.prod, group.strlim
+        nbrs = group.cells[:, 1:]
+        own = pstrn[:, 0]
+        stays = (own == 0) | ((own + istrn + prod) <= strlim) | \
+            ((255 - own - istrn) > istrn)
+
+        # Can technically lose to cap here since I skip checking pstrn
+        enemy_strn = gm.enemy.ravel()[nbrs] * gm.strn.ravel()[nbrs]
+        blank_strn = gm.blank.ravel()[nbrs] * gm.prod.ravel()[nbrs] * \
+            (gm.strnc.ravel()[nbrs] < istrn[:, None]) * gm.safe_to_take.ravel()[nbrs]
+        owned_strn = gm.owned.ravel()[nbrs] * (pstrn[:, 1:] + gm.strn.ravel()[nbrs])
+        owned_strn[owned_strn == 0] = 999
+
+        to = np.select(
+            [stays, enemy_strn.max(axis=1, initial=0) > 1,
+             blank_strn.max(axis=1, initial=0) > 0.5],
+            [0, enemy_strn.argmax(axis=1) + 1, blank_strn.argmax(axis=1) + 1],
+            owned_strn.argmin(axis=1) + 1
+        ) if len(nbrs) else np.zeros(0, dtype=int)
+        return to, to, np.where(stays, istrn + prod, istrn)
+
+    @staticmethod
+    def step_prefs(gm, origins, targets):
+        """First and second preferred steps of every black square as
+        0-4 indices (second is -1 if there is none). Pieces close to
+        combat head down dist_from_combat avoiding walls, the two ways
+        down ordered by closeness to the target; the rest follow
+        find_pref_nexts.
+        """
+        if not len(origins):
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        ax, ay = origins[:, 0], origins[:, 1]
+        tx, ty = targets[:, 0], targets[:, 1]
+        (_, _, first), (_, _, second) = find_pref_nexts(
+            ax, ay, tx, ty, gm, safe_steps(gm))
+
+        close = (gm.close_to_combat[ax, ay] != 0) & ~((ax == tx) & (ay == ty))
+        nbrs = gm.nbr_idx[ax * gm.height + ay]
+        downhill = (gm.dist_from_combat.ravel()[nbrs] <
+                    gm.dist_from_combat[ax, ay][:, None]) & ~gm.wall.ravel()[nbrs]
+        nx, ny = np.divmod(nbrs, gm.height)
+        cdists = gm.dists.between(tx[:, None], ty[:, None], nx, ny) + \
+            gm.prod.ravel()[nbrs] * 0.01
+
+        # With exactly two ways down, lo and hi are them in N, E, S, W
+        # order and the closer one (lo on a tie) goes first
+        count = downhill.sum(axis=1)
+        lo = downhill.argmax(axis=1)
+        hi = 3 - downhill[:, ::-1].argmax(axis=1)
+        rows = np.arange(len(origins))
+        swap = (count == 2) & (cdists[rows, hi] < cdists[rows, lo])
+
+        close_first = np.where(count == 0, 0, np.where(swap, hi, lo) + 1)
+        close_second = np.where(count == 2, np.where(swap, lo, hi) + 1, -1)
+        return np.where(close, close_first, first), \
+            np.where(close, close_second, second)
@@ -0,0 +1,98 @@
+"""Picking noncombat targets for every motile piece at once."""
+
+
+import numpy as np
+
+
+class TargetScores:
+    """The cell each piece of a turn would target in
+    MoveMaker.decide_noncombat_moves, scored for all pieces in one go.
+
+    A piece at a scores cell c as
+        Vmid[c] / (dist(a, c) + t2c) * d1_conquered[c] +
+        Vglob[c] / (dist(a, c) + bulk_off)
+    doubled at c == a, where t2c is the turns it takes a to out-grow c.
+    Only cells where Vmid or Vglob is nonzero can score above zero, so
+    just those are scored, chunk pieces x cells at a time, and a piece
+    with nothing above zero targets cell 0 as the full-map argmax did.
+
+    Pieces are looked up in turn order with target(); conquer() zeroes
+    d1_conquered at a cell. Only the pieces still to go whose pick was
+    that cell are rescored, so the targets are the same as scoring
+    every piece over the whole map in order.
+    """
+
+    def __init__(self, dists, pieces, strn, prodc, Vmid, Vglob, bulk_off,
+                 chunk=2 ** 20):
+        """pieces is the (n, 2) array of piece coordinates."""
+        self.w, self.h = strn.shape
+        self.dists = dists
+        self.bulk_off = bulk_off
+
+        self.ax, self.ay = pieces[:, 0], pieces[:, 1]
+        self.a = self.ax * self.h + self.ay
+        self.astrn = strn[self.ax, self.ay]
+
+        self.cand = np.flatnonzero((Vmid != 0) | (Vglob != 0))
+        self.cx, self.cy = np.divmod(self.cand, self.h)
+        self.cstrn = strn.ravel()[self.cand]
+        self.cprodc = prodc.ravel()[self.cand]
+        self.Vmid = Vmid.ravel()[self.cand]
+        self.Vglob = Vglob.ravel()[self.cand]
+
+        self.d1_conquered = np.ones(len(self.cand), dtype=bool)
+        self.any_conquered = False
+
+        n = len(pieces)
+        self.best = np.zeros(n, dtype=int)
+        self.finite = np.ones(n, dtype=bool)
+        self.done = np.zeros(n, dtype=bool)
+        self.step = max(1, chunk // max(1, len(self.cand)))
+        self._rescore(np.arange(n))
+
+    def _rescore(self, rows):
+        for i in range(0, len(rows), self.step):
+            chunk = rows[i:(i + self.step)]
+            S = self._scores(chunk)
+            self.best[chunk] = self._argmax(S)
+            self.finite[chunk] = np.isfinite(S).all(axis=1)
+
+    def _scores(self, rows):
+        """The len(rows) x candidates scores under d1_conquered."""
+        D = self.dists.between(self.ax[rows, None], self.ay[rows, None],
+                               self.cx[None, :], self.cy[None, :])
+        t2c = np.maximum(
+            0, (self.cstrn[None, :] - self.astrn[rows, None]) / self.cprodc
+        )
+        S = np.divide(self.Vmid, (D + t2c)) * self.d1_conquered + \
+            np.divide(self.Vglob, (D + self.bulk_off))
+        S[self.cand[None, :] == self.a[rows, None]] *= 2
+        return S
+
+    def _argmax(self, S):
+        """Flat index of the first best cell of each row of S."""
+        if not len(self.cand):
+            return np.zeros(len(S), dtype=int)
+        J = S.argmax(axis=1)
+        V = S[np.arange(len(S)), J]
+        return np.where(V == 0, 0, self.cand[J])
+
+    def target(self, i):
+        """The (x, y) target of piece i given the cells conquered so far."""
+        self.done[i] = True
+        if self.any_conquered and not self.finite[i]:
+            self._rescore(np.array([i]))
+        return divmod(self.best[i], self.h)
+
+    def conquer(self, x, y):
+        """Set d1_conquered to 0 at (x, y). That only lowers scores, so
+        the picks of pieces that wanted another cell stand; those with
+        inf/nan scores about are rescored as they come up. Cells that
+        are not candidates score zero either way.
+        """
+        c = x * self.h + y
+        j = np.searchsorted(self.cand, c)
+        if j < len(self.cand) and self.cand[j] == c:
+            self.any_conquered = True
+            self.d1_conquered[j] = 0
+            self._rescore(np.flatnonzero((self.best == c) & ~self.done))
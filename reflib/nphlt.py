@@ -12,8 +12,9 @@ GameMap.owner contains each cell's owner.
 import sys
 import numpy as np
 from collections import namedtuple
-from scipy.ndimage.filters import generic_filter, maximum_filter
+from scipy.ndimage.filters import maximum_filter
 from reflib.dijkstra import ShortestPather
+from reflib.stencil import torus_filter, PLUS, SQUARE
 
 # import logging
 
@@ -247,22 +248,16 @@ class ImprovedGameMap(GameMap):
     def plus_filter(X, f):
         """Scans a +-shaped filter over the input matrix X, applies
         the reducer function f and returns a new matrix with the same
-        dimensions of X containing the reduced values.
+        dimensions of X containing the reduced values. f is one of
+        sum, max, min or any (or their names); see stencil.torus_filter.
         """
-        footprint = np.array([[0, 1, 0],
-                              [1, 1, 1],
-                              [0, 1, 0]])
-        proc = generic_filter(X, f, footprint=footprint, mode='wrap')
-        return proc
+        return torus_filter(X, PLUS, f)
 
     @staticmethod
     def square_filter(X, f):
         """Scans a square-shaped filter over the input matrix X, applies
         the reducer function f and returns a new matrix with the same
-        dimensions of X containing the reduced values.
+        dimensions of X containing the reduced values. f is one of
+        sum, max, min or any (or their names); see stencil.torus_filter.
         """
-        footprint = np.array([[1, 1, 1],
-                              [1, 1, 1],
-                              [1, 1, 1]])
-        proc = generic_filter(X, f, footprint=footprint, mode='wrap')
-        return proc
+        return torus_filter(X, SQUARE, f)
@@ -0,0 +1,80 @@
+"""Torus-aware stencils.
+
+Vectorized stand-ins for generic_filter(X, f, footprint, mode='wrap').
+A footprint is a tuple of (dx, dy) offsets and every offset is applied
+as a wrapped block copy, so the reducer runs once per offset over the
+whole map instead of once per cell in Python.
+"""
+
+
+import numpy as np
+
+
+PLUS = ((0, 0), (0, -1), (1, 0), (0, 1), (-1, 0))
+SQUARE = ((0, 0), (-1, -1), (-1, 0), (-1, 1), (0, -1),
+          (0, 1), (1, -1), (1, 0), (1, 1))
+
+REDUCERS = {
+    'sum': np.add,
+    'max': np.maximum,
+    'min': np.minimum,
+    'any': np.logical_or,
+}
+
+# So the old plus_filter(X, max) style calls keep working.
+BUILTINS = {sum: 'sum', max: 'max', min: 'min', any: 'any'}
+
+
+def diamond(k):
+    """All offsets within manhattan distance k of the centre,
+    centre first.
+    """
+    offsets = [(0, 0)]
+    for dx in range(-k, k + 1):
+        span = k - abs(dx)
+        for dy in range(-span, span + 1):
+            if dx or dy:
+                offsets.append((dx, dy))
+    return tuple(offsets)
+
+
+def torus_filter(X, footprint, reducer, out=None):
+    """Reduce X over footprint with wraparound at every edge.
+    reducer is one of REDUCERS or the matching builtin. The result
+    has the dtype of X (bool for 'any') and is written to out if
+    given; out must not share memory with X.
+    """
+    reducer = BUILTINS.get(reducer, reducer)
+    ufunc = REDUCERS[reducer]
+    if out is None:
+        out = np.empty(X.shape, dtype=bool if reducer == 'any' else X.dtype)
+
+    (dx, dy), rest = footprint[0], footprint[1:]
+    _shifted(X, dx, dy, out, _copy)
+    for dx, dy in rest:
+        _shifted(X, dx, dy, out, ufunc)
+
+    return out
+
+
+def _copy(a, b, out):
+    np.copyto(out, b, casting='unsafe')
+
+
+def _shifted(X, dx, dy, out, f):
+    """Apply out[x, y] = f(out[x, y], X[x + dx, y + dy]) over the
+    torus as at most four rectangular block operations.
+    """
+    w, h = X.shape
+    for ox, ix in _blocks(dx % w, w):
+        for oy, iy in _blocks(dy % h, h):
+            dst = out[ox, oy]
+            f(dst, X[ix, iy], out=dst)
+
+
+def _blocks(d, n):
+    """Output/input slice pairs covering an axis of length n shifted by d."""
+    if d == 0:
+        return ((slice(0, n), slice(0, n)),)
+    return ((slice(0, n - d), slice(d, n)),
+            (slice(n - d, n), slice(0, d)))
@@ -0,0 +1,99 @@
+"""Time noncombat target selection on a synthetic 50x50 map across
+piece counts: per piece against batched targets mode, and field mode
+(MoveMaker(mode='field')) next to them. Run from the repo root:
+    python3 scripts/bench_targets.py
+"""
+
+
+import os
+import sys
+import time
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dexlib.distances import TorusDistances
+from dexlib.targeting import TargetScores
+from dexlib.dijkstra import potential_field
+from dexlib.nphlt import ImprovedGameMap
+
+
+W = H = 50
+BULK_OFF = 10
+
+
+def make_map(n_pieces, seed=0):
+    """A blob of owned cells with values on its border."""
+    rng = np.random.default_rng(seed)
+    strn = rng.integers(0, 256, (W, H))
+    prodc = rng.integers(1, 12, (W, H))
+
+    dists = TorusDistances(W, H)
+    owned = np.zeros((W, H), dtype=bool)
+    owned.ravel()[np.argsort(dists[W // 2, H // 2], axis=None, kind='stable')[:n_pieces]] = True
+    border = ~owned & (np.roll(owned, 1, 0) | np.roll(owned, -1, 0) |
+                       np.roll(owned, 1, 1) | np.roll(owned, -1, 1))
+    Vmid = rng.random((W, H)) * border
+    Vglob = rng.random((W, H)) * border * (rng.random((W, H)) < 0.5)
+    return dists, np.transpose(np.nonzero(owned)), strn, prodc, Vmid, Vglob
+
+
+def per_piece(dists, pieces, strn, prodc, Vmid, Vglob):
+    """The full-map scoring decide_noncombat_moves used to do."""
+    d1_conquered = np.ones_like(Vmid, dtype=bool)
+    targets = []
+    for ax, ay in pieces:
+        t2c = np.maximum(0, (strn - strn[ax, ay]) / prodc)
+        prox_value = np.divide(Vmid, (dists[ax, ay] + t2c)) * d1_conquered + \
+            np.divide(Vglob, (dists[ax, ay] + BULK_OFF))
+        prox_value[ax, ay] *= 2
+        tx, ty = np.unravel_index(prox_value.argmax(), prox_value.shape)
+        targets.append((tx, ty))
+        if dists[ax, ay, tx, ty] == 1 and strn[ax, ay] > strn[tx, ty]:
+            d1_conquered[tx, ty] = 0
+    return targets
+
+
+def batched(dists, pieces, strn, prodc, Vmid, Vglob):
+    scores = TargetScores(dists, pieces, strn, prodc, Vmid, Vglob, BULK_OFF)
+    targets = []
+    for i, (ax, ay) in enumerate(pieces):
+        tx, ty = scores.target(i)
+        targets.append((tx, ty))
+        if dists[ax, ay, tx, ty] == 1 and strn[ax, ay] > strn[tx, ty]:
+            scores.conquer(tx, ty)
+    return targets
+
+
+def field(dists, pieces, strn, prodc, Vmid, Vglob):
+    """The steps follow_field picks, down one potential field."""
+    owned = np.zeros((W, H), dtype=int)
+    owned[pieces[:, 0], pieces[:, 1]] = 1
+    nbr_idx = ImprovedGameMap.get_neighbour_index(W, H)
+    gm = SimpleNamespace(width=W, height=H, owners=owned, owned=owned,
+                         nbr_idx=nbr_idx)
+
+    values = potential_field(gm, Vmid + Vglob, BULK_OFF).ravel()
+    flat = pieces[:, 0] * H + pieces[:, 1]
+    nbrs = nbr_idx[flat]
+    step = values[nbrs].argmin(axis=1)
+    to = np.where(values[nbrs[np.arange(len(flat)), step]] < values[flat],
+                  nbrs[np.arange(len(flat)), step], flat)
+    return list(zip(*np.divmod(to, H)))
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    print('%8s %12s %12s %8s %12s' % ('pieces', 'per piece', 'targets', 'same', 'field'))
+    for n in (10, 50, 100, 250, 500, 1000, 2000):
+        args = make_map(n)
+        old, t_old = timed(per_piece, *args)
+        new, t_new = timed(batched, *args)
+        _, t_field = timed(field, *args)
+        print('%8d %10.1fms %10.1fms %8s %10.1fms' % (n, t_old, t_new, old == new, t_field))
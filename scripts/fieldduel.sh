@@ -0,0 +1,14 @@
+#!/bin/bash
+# Pit the two expansion modes against each other, counting wins, then
+# time each mode's target selection side by side (make bench).
+# usage: fieldduel.sh [games]
+games=${1:-50}
+rm -f duel.out
+for i in $(seq 1 $games)
+do
+    halite -d "30 30" "python3 MyBot.py targets" "python3 MyBot.py field" >> duel.out
+done
+echo "targets: $(grep "rank #1" duel.out | grep -c "DexBotNeuer")"
+echo "field:   $(grep "rank #1" duel.out | grep -c "DexBotField")"
+echo
+python3 scripts/bench_targets.py
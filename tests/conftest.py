@@ -0,0 +1,63 @@
+"""Synthetic games for driving the map classes without a halite
+environment: an init block and frame lines fed through stdin.
+"""
+
+
+import io
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def encode_frame(owners, strn):
+    """A frame line for x*y owners and strn, as the environment sends it."""
+    owners, strn = owners.T.ravel(), strn.T.ravel()
+    starts = np.flatnonzero(np.diff(owners, prepend=-1))
+    counts = np.diff(np.append(starts, len(owners)))
+    runs = np.stack((counts, owners[starts]), axis=1).ravel()
+    return (' '.join(map(str, np.concatenate((runs, strn)))) + '\n').encode()
+
+
+def synthetic_game(w, h, turns, seed=0, players=3):
+    """Production line and turns + 1 frame lines of a made up game:
+    players spread out from a corner each, owned cells gain their
+    production and now and then one is emptied.
+    """
+    rng = np.random.default_rng(seed)
+    prod = rng.integers(1, 12, (w, h))
+    strn = rng.integers(5, 200, (w, h))
+    owners = np.zeros((w, h), dtype=int)
+    for player in range(1, players + 1):
+        x, y = rng.integers(w), rng.integers(h)
+        owners[x:x + 3, y:y + 3] = player
+
+    prod_line = (' '.join(map(str, prod.T.ravel())) + '\n').encode()
+    frames = []
+    for _ in range(turns + 1):
+        for player in range(1, players + 1):
+            xs, ys = np.nonzero(owners == player)
+            for i in rng.integers(len(xs), size=min(3, len(xs))):
+                dx, dy = ((0, 1), (1, 0), (0, -1), (-1, 0))[rng.integers(4)]
+                owners[(xs[i] + dx) % w, (ys[i] + dy) % h] = player
+        strn = np.where(owners > 0, np.minimum(255, strn + prod), strn)
+        strn[(rng.random((w, h)) < 0.05) & (owners > 0)] = 0
+        frames.append(encode_frame(owners, strn))
+    return prod_line, frames
+
+
+@pytest.fixture
+def game(monkeypatch):
+    """Point stdin at a synthetic game for player 1, init block and
+    every frame, and return its frame lines.
+    """
+    def start(w=20, h=20, turns=30, seed=0):
+        prod_line, frames = synthetic_game(w, h, turns, seed)
+        init = b'1\n' + ('%d %d\n' % (w, h)).encode() + prod_line
+        stdin = io.BytesIO(init + b''.join(frames))
+        monkeypatch.setattr(sys, 'stdin', io.TextIOWrapper(stdin))
+        return frames
+    return start
@@ -0,0 +1,51 @@
+"""NearestBorders carried across turns against solving from scratch."""
+
+
+import numpy as np
+import pytest
+
+from dexlib.dijkstra import ShortestPather
+from dexlib.bordervalue import NearestBorders
+
+
+def random_pather(rng, w, h, lazy):
+    strn = rng.integers(0, 256, (w, h))
+    prod = rng.integers(0, 16, (w, h))
+    return ShortestPather(strn, prod, lazy=lazy)
+
+
+@pytest.mark.parametrize('seed', range(8))
+@pytest.mark.parametrize('lazy', [False, True])
+def test_update_matches_solve(seed, lazy):
+    rng = np.random.default_rng(seed)
+    w, h = rng.integers(3, 12, 2)
+    n = w * h
+    sp = random_pather(rng, w, h, lazy)
+    # A small chunk so update and solve both go through several blocks
+    nearest = NearestBorders(sp, chunk=int(rng.integers(1, 64)),
+                             max_change=float(rng.choice([0.05, 0.25, 1.0])))
+
+    B = rng.random(n) < 0.2
+    U = rng.random(n) < 0.4
+    nearest.solve(np.flatnonzero(B), np.flatnonzero(U))
+
+    for turn in range(30):
+        # Flip a few cells, and pass some that did not change as well
+        B_cells = rng.choice(n, int(rng.integers(0, n // 4 + 1)), replace=False)
+        U_cells = rng.choice(n, int(rng.integers(0, n // 4 + 1)), replace=False)
+        B[B_cells] ^= rng.random(len(B_cells)) < 0.5
+        U[U_cells] ^= rng.random(len(U_cells)) < 0.5
+        if not B.any() or not U.any():
+            B[rng.integers(n)] = U[rng.integers(n)] = True
+            nearest.reset()
+            nearest.solve(np.flatnonzero(B), np.flatnonzero(U))
+            continue
+
+        keys, Umin = nearest.update(B_cells, B[B_cells], U_cells, U[U_cells])
+        ref_keys, ref_Umin = NearestBorders(sp).solve(np.flatnonzero(B),
+                                                      np.flatnonzero(U))
+
+        assert (nearest.Bis == np.flatnonzero(B)).all()
+        assert (nearest.Uis == np.flatnonzero(U)).all()
+        assert (keys == ref_keys).all()
+        assert (Umin == ref_Umin).all()
@@ -0,0 +1,129 @@
+"""A turn that runs over its budget still sends a full frame in time."""
+
+
+import os
+import signal
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+from conftest import synthetic_game
+from dexlib.deadline import Deadline, TurnTimeout, uninterrupted
+from dexlib.nphlt import decode_frame
+
+# Cutting a stage short takes the alarm
+needs_alarm = pytest.mark.skipif(not hasattr(signal, 'setitimer'),
+                                 reason='no setitimer')
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Budget the bot is given here, well inside the 1s the test allows a
+# turn, so starting the process and the pipes have room to spare
+BUDGET = 0.3
+
+# MyBot with noncombat sleeping 2s after its targets are picked from
+# the fourth turn on. How long each sleep really lasted goes to slept.
+SLOW_BOT = '''
+import runpy, sys, time
+import dexlib.deadline
+from dexlib.movement import MoveMaker
+
+
+class Deadline(dexlib.deadline.Deadline):
+    def __init__(self, budget):
+        super().__init__(%r)
+
+
+decide = MoveMaker.decide_noncombat_moves
+turns = [0]
+
+def slow_noncombat(self, gm, moveset):
+    moveset = decide(self, gm, moveset)
+    turns[0] += 1
+    if turns[0] > 3:
+        start = time.perf_counter()
+        try:
+            time.sleep(2)
+        finally:
+            with open('slept', 'a') as slept:
+                slept.write('%%f\\n' %% (time.perf_counter() - start))
+    return moveset
+
+dexlib.deadline.Deadline = Deadline
+MoveMaker.decide_noncombat_moves = slow_noncombat
+sys.argv = ['MyBot.py']
+runpy.run_path(%r, run_name='__main__')
+''' % (BUDGET, os.path.join(REPO, 'MyBot.py'))
+
+
+@needs_alarm
+def test_slow_stage_still_sends_frame(tmp_path):
+    w, h = 20, 20
+    prod_line, frames = synthetic_game(w, h, turns=8, seed=1)
+    bot = subprocess.Popen(
+        [sys.executable, '-c', SLOW_BOT], cwd=tmp_path,
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+        env=dict(os.environ, PYTHONPATH=REPO, PYTHONWARNINGS='ignore'))
+    try:
+        bot.stdin.write(b'1\n%d %d\n' % (w, h) + prod_line + frames[0])
+        bot.stdin.flush()
+        assert bot.stdout.readline().strip()
+
+        moved = 0
+        for turn, frame in enumerate(frames[1:]):
+            bot.stdin.write(frame)
+            bot.stdin.flush()
+            start = time.perf_counter()
+            line = bot.stdout.readline()
+            took = time.perf_counter() - start
+            assert line, 'bot died on turn %d' % turn
+            assert took < 1.0, 'turn %d took %.2fs' % (turn, took)
+
+            # One move for every owned piece, each a direction 0-4
+            x, y, dirs = np.fromstring(line, dtype=int, sep=' ').reshape((-1, 3)).T
+            owners = decode_frame(frame, w, h)[0]
+            assert sorted(zip(x, y)) == sorted(zip(*np.nonzero(owners == 1)))
+            assert ((0 <= dirs) & (dirs <= 4)).all()
+            if turn >= 3:
+                moved += np.count_nonzero(dirs)
+        # Turns cut short still move the pieces that had targets
+        assert moved
+    finally:
+        bot.kill()
+        bot.wait()
+
+    # Every slow turn was cut short in the injected sleep, about BUDGET
+    # into the turn and far from the 2s it asked for
+    slow_turns = len(frames) - 1 - 3
+    with open(tmp_path / 'slept') as slept:
+        slept = [float(line) for line in slept]
+    assert len(slept) == slow_turns
+    assert max(slept) < 1.0
+    with open(tmp_path / 'wtf.info') as log:
+        timeouts = [line for line in log if 'over its' in line]
+    assert len(timeouts) == slow_turns
+    assert all('over its %.0fms budget in noncombat' % (BUDGET * 1000) in line
+               for line in timeouts)
+
+
+@needs_alarm
+def test_timeout_waits_for_uninterrupted():
+    deadline = Deadline(0.05)
+    done = []
+
+    @uninterrupted
+    def write():
+        time.sleep(0.1)
+        done.append(True)
+
+    deadline.start()
+    with pytest.raises(TurnTimeout) as timeout:
+        with deadline.stage('write'):
+            write()
+            done.append(False)
+    deadline.stop()
+    assert done == [True]
+    assert timeout.value.stage == 'write'
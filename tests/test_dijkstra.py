@@ -0,0 +1,59 @@
+"""The expansion potential field."""
+
+
+from types import SimpleNamespace
+
+import numpy as np
+
+from dexlib.dijkstra import potential_field
+from dexlib.nphlt import ImprovedGameMap
+
+
+def strip_map(w=10, h=3):
+    """Owned cells (1..w-2, 1) between two unowned ends (0, 1) and
+    (w-1, 1).
+    """
+    owned = np.zeros((w, h), dtype=int)
+    owned[1:w - 1, 1] = 1
+    return SimpleNamespace(width=w, height=h, owners=owned, owned=owned,
+                           nbr_idx=ImprovedGameMap.get_neighbour_index(w, h))
+
+
+def downhill(field, x, y=1):
+    """-1 if the piece at x, y steps west, 1 east, 0 if it stays."""
+    west, here, east = field[x - 1, y], field[x, y], field[x + 1, y]
+    if min(west, east) >= here:
+        return 0
+    return -1 if west < east else 1
+
+
+def test_field_leads_to_the_best_target():
+    gm = strip_map()
+    values = np.zeros((gm.width, gm.height))
+    values[0, 1], values[-1, 1] = 1, 4
+    field = potential_field(gm, values, 10)
+
+    # 3 steps + 10 * 4 / 1 west against 6 steps + 10 east
+    assert field[3, 1] == 16
+    assert all(downhill(field, x) == 1 for x in range(1, gm.width - 1))
+    assert np.isinf(field[:, 0]).all()
+
+    # Close enough, the weaker target wins
+    values[-1, 1] = 1.2
+    field = potential_field(gm, values, 1)
+    assert downhill(field, 2) == -1
+    assert downhill(field, 7) == 1
+
+
+def test_infinite_values_come_first():
+    gm = strip_map()
+    values = np.zeros((gm.width, gm.height))
+    values[0, 1], values[-1, 1] = np.inf, 4
+    field = potential_field(gm, values, 10)
+
+    assert field[1, 1] == 1
+    assert all(downhill(field, x) == -1 for x in range(1, gm.width - 1))
+
+    values[-1, 1] = np.inf
+    field = potential_field(gm, values, 10)
+    assert field[1, 1] == field[-2, 1] == 1
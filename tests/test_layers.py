@@ -0,0 +1,62 @@
+"""Map state kept in preallocated, double-buffered layers."""
+
+
+import tracemalloc
+
+import numpy as np
+
+from dexlib.nphlt import ImprovedGameMap, decode_frame
+
+
+def test_turns_allocate_flat(game):
+    game(turns=40)
+    gm = ImprovedGameMap(8)
+    for _ in range(10):
+        gm.get_frame()
+        gm.update()
+    layers = {name: gm.__dict__[name] for name in gm.layers.layers if name in gm.__dict__}
+
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        peaks = []
+        for _ in range(25):
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            gm.get_frame()
+            gm.update()
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        grown = tracemalloc.get_traced_memory()[0] - start
+    finally:
+        tracemalloc.stop()
+
+    # No turn allocates as much as one fresh copy of the layers it
+    # derives (a full border recompute now and then comes closest), and
+    # nothing piles up beyond the border and territory lists growing
+    # with the territory (a layer a turn would be 25)
+    assert np.median(peaks) < gm.layers.nbytes() / 2
+    assert max(peaks) < gm.layers.nbytes()
+    assert grown < gm.layers.nbytes() / 4
+    for name, buf in layers.items():
+        assert gm.__dict__.get(name, buf) is buf
+        assert buf.flags.c_contiguous
+
+
+def test_strn_edits_stay_out_of_the_frames(game):
+    frames = game(turns=3)
+    gm = ImprovedGameMap(8)
+    gm.get_frame()
+    gm.update()
+    prev = decode_frame(frames[1], gm.width, gm.height)[1]
+    cur = decode_frame(frames[2], gm.width, gm.height)[1]
+
+    # What process_d1_teamups does to trick the pathfinder
+    x, y = np.argwhere(gm.strn > 0)[0]
+    gm.strn[x, y] = 0
+
+    gm.get_frame()
+    gm.update()
+    assert gm.strn_edited
+    assert (gm.prev_strn == prev).all()
+    assert (gm.strn == cur).all()
+    assert (gm.diff.strn_changed == (cur != prev)).all()